@@ -0,0 +1,585 @@
+'''
+Data structures of the Birdee language server which do not depend on the
+compiler, so that they can be benchmarked without birdeec.
+'''
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+import heapq
+import re
+
+'''
+maps source positions to the AST nodes starting there. Birdee marks an
+expression by the position where it ends, so the candidates of a cursor
+position are the nodes on the same line at or after the cursor, plus the
+nodes at the start of the next line. The nodes of each line are kept sorted
+by column, so a lookup is a binary search on a single line
+'''
+class PositionIndex:
+    def __init__(self):
+        self.pending = dict() # int(line) -> list of (int(column), node)
+        self.lines = dict() # int(line) -> (list of int(column), list of nodes), sorted by column
+
+    def add(self, line, column, node):
+        self.pending.setdefault(line, []).append((column, node))
+
+    def finish(self):
+        for line, items in self.pending.items():
+            items.sort(key=lambda x: x[0])
+            self.lines[line] = ([c for c, _ in items], [n for _, n in items])
+        self.pending = dict()
+        return self
+
+    '''
+    line and column are 1-based, like SourcePos. Returns a list of
+    (distance, node) sorted by the distance to the cursor
+    '''
+    def find(self, line, column, line_length) -> list:
+        res = []
+        if line in self.lines:
+            columns, nodes = self.lines[line]
+            for i in range(bisect_left(columns, column), len(columns)):
+                res.append((columns[i] - column, nodes[i]))
+        if line + 1 in self.lines:
+            columns, nodes = self.lines[line + 1]
+            for i in range(bisect_left(columns, 1), bisect_right(columns, 1)):
+                res.append((line_length - column, nodes[i]))
+        res.sort(key=lambda x: x[0])
+        return res
+
+    def __len__(self):
+        return sum(len(columns) for columns, _ in self.lines.values())
+
+'''
+the nodes near a position found by walking only the top-level items around
+its line, with the same result as PositionIndex.find. It is cheaper than
+building the index for a single lookup
+'''
+def find_near(tl, line, column, line_length) -> list:
+    res = []
+    def runfunc(ast):
+        if not ast:
+            return
+        if ast.pos.line == line and ast.pos.pos >= column:
+            res.append((ast.pos.pos - column, ast))
+        #Birdee compiler marks the end of the expression, maybe in the next line
+        if ast.pos.line == line + 1 and ast.pos.pos == 1:
+            res.append((line_length - column, ast))
+        ast.run(runfunc)
+    if not tl:
+        return res
+    for idx, a in enumerate(tl):
+        if a.pos.line >= line - 1:
+            if idx > 0: runfunc(tl[idx - 1])
+            if idx > 1: runfunc(tl[idx - 2])
+            runfunc(tl[idx])
+            if idx + 1 < len(tl): runfunc(tl[idx + 1])
+            break
+    else:
+        runfunc(tl[len(tl) - 1])
+    res.sort(key=lambda x: x[0])
+    return res
+
+'''
+a bounded least-recently-used cache. Each entry is stored with a version and
+a lookup only hits if the version still matches, so stale entries are
+replaced on the next lookup instead of being invalidated explicitly
+'''
+class LRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict() # key -> (version, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, value):
+        self.entries[key] = (version, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self.entries), "capacity": self.capacity, "hits": self.hits,
+            "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+class TrieNode:
+    __slots__ = ("children", "origins")
+
+    def __init__(self):
+        self.children = dict() # str(name) -> TrieNode
+        self.origins = set() # where the module is found, empty if the node is only a package
+
+'''
+a prefix tree of module paths. A module may be provided by several origins
+(e.g. the source root and the cache dir), and it is removed from the trie
+only when no origin provides it and it has no sub-modules
+'''
+class ModuleTrie:
+    def __init__(self):
+        self.root = TrieNode()
+
+    def add(self, mod, origin):
+        node = self.root
+        for name in mod:
+            child = node.children.get(name)
+            if child is None:
+                child = TrieNode()
+                node.children[name] = child
+            node = child
+        node.origins.add(origin)
+
+    def remove(self, mod, origin):
+        path = [self.root]
+        for name in mod:
+            child = path[-1].children.get(name)
+            if child is None:
+                return
+            path.append(child)
+        path[-1].origins.discard(origin)
+        for i in range(len(mod), 0, -1):
+            node = path[i]
+            if node.origins or node.children:
+                break
+            del path[i - 1].children[mod[i - 1]]
+
+    def __contains__(self, mod):
+        node = self.root
+        for name in mod:
+            node = node.children.get(name)
+            if node is None:
+                return False
+        return bool(node.origins)
+
+    '''
+    the names directly under a module prefix, as a list of
+    (name, is_module, has_sub_modules)
+    '''
+    def children(self, prefix) -> list:
+        node = self.root
+        for name in prefix:
+            node = node.children.get(name)
+            if node is None:
+                return []
+        return [(name, bool(child.origins), bool(child.children)) for name, child in node.children.items()]
+
+    '''
+    all the modules provided by an origin
+    '''
+    def modules(self, origin) -> list:
+        ret = []
+        stack = [((), self.root)]
+        while stack:
+            prefix, node = stack.pop()
+            if origin in node.origins:
+                ret.append(prefix)
+            for name, child in node.children.items():
+                stack.append((prefix + (name,), child))
+        return ret
+
+'''
+the modules imported by a Birdee source, read from the import lines at the
+head of the file without compiling it. "import a.b" and "import a.b:c" both
+import the module a.b. Parsing stops at the first line which is not a
+package or import declaration
+'''
+def parse_imports(source) -> list:
+    ret = []
+    for line in source.split("\n"):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("package "):
+            continue
+        if not line.startswith("import "):
+            break
+        tokens = line[len("import "):].split()
+        if not tokens:
+            continue
+        name = tokens[0].split(":")[0]
+        if name:
+            ret.append(tuple(name.split(".")))
+    return ret
+
+'''
+latency samples of one kind of operation. The recent samples are kept for
+percentiles, and all the samples are counted in fixed buckets
+'''
+class LatencyHistogram:
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, recent=1000):
+        self.recent = deque(maxlen=recent)
+        self.buckets = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, ms):
+        self.recent.append(ms)
+        self.buckets[bisect_right(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+
+    def percentile(self, samples, p):
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def summary(self) -> dict:
+        samples = sorted(self.recent)
+        buckets = dict()
+        for i, n in enumerate(self.buckets):
+            buckets["<{}".format(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else ">={}".format(self.BUCKETS_MS[-1])] = n
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(samples, 50), "p95": self.percentile(samples, 95),
+            "p99": self.percentile(samples, 99), "max": samples[-1] if samples else 0.0,
+            "buckets_ms": buckets}
+
+'''
+the innermost call around the cursor, found by a lexical scan of a single
+line without compiling. Returns (column of the open paren, index of the
+active argument), or None if the cursor is not in a call opened on this line,
+or if the scan meets something it does not follow (comments, triple-quoted
+strings or python blocks)
+'''
+def find_call_site(line, column):
+    stack = [] # [bracket, column of the bracket, number of commas] of the open brackets
+    end = min(column, len(line))
+    i = 0
+    while i < end:
+        c = line[i]
+        if c == '"':
+            if line.startswith('"""', i):
+                return None
+            i += 1
+            while i < end and line[i] != '"':
+                i += 2 if line[i] == "\\" else 1
+            if i >= end:
+                return None
+        elif c == "#" or line.startswith("{@", i):
+            return None
+        elif c == "(" or c == "[":
+            stack.append([c, i, 0])
+        elif c == ")" or c == "]":
+            if stack:
+                stack.pop()
+        elif c == "," and stack:
+            stack[-1][2] += 1
+        i += 1
+    if not stack or stack[-1][0] != "(":
+        return None
+    return stack[-1][1], stack[-1][2]
+
+'''
+a dict of strings bounded by their total length. Reading an entry with []
+marks it as recently used, and evict() removes the least recently used
+entries accepted by a predicate until the total fits in the budget. The most
+recently used entry is never evicted, so a value just stored can be read
+back even if it alone exceeds the budget
+'''
+class BudgetedDict:
+    def __init__(self, budget=0):
+        self.budget = budget # total length of the values, 0 for unbounded
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        value = self.entries[key]
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def __setitem__(self, key, value):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+
+    def pop(self, key, default=None):
+        value = self.entries.pop(key, None)
+        if value is None:
+            return default
+        self.size -= len(value)
+        return value
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def evict(self, can_evict) -> list:
+        ret = []
+        if not self.budget or self.size <= self.budget:
+            return ret
+        for key in list(self.entries)[:-1]:
+            if self.size <= self.budget:
+                break
+            if can_evict(key):
+                self.size -= len(self.entries.pop(key))
+                ret.append(key)
+        self.evictions += len(ret)
+        return ret
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "size": self.size, "budget": self.budget,
+            "evictions": self.evictions}
+
+def is_subsequence(query, name) -> bool:
+    it = iter(name)
+    return all(c in it for c in query)
+
+def subsequence_pattern(query):
+    return re.compile(".*?".join(re.escape(c) for c in query), re.DOTALL)
+
+'''
+a search index of symbol names. Each symbol is indexed by the characters and
+the trigrams of its lowercased name: a query of three or more characters is
+looked up by its trigrams, and a fuzzy query (the characters of the query in
+order, not necessarily adjacent) by its characters. The symbols of a module
+are replaced together when the module changes
+'''
+class SymbolIndex:
+    def __init__(self):
+        self.symbols = dict() # int(id) -> (name, lowercased name, data)
+        self.modules = dict() # module -> list of int(id)
+        self.grams = dict() # str(character or trigram) -> set of int(id)
+        self.next_id = 0
+
+    @staticmethod
+    def grams_of(lower) -> set:
+        ret = set(lower)
+        for i in range(len(lower) - 2):
+            ret.add(lower[i:i + 3])
+        return ret
+
+    def remove(self, mod):
+        for sid in self.modules.pop(mod, ()):
+            _, lower, _ = self.symbols.pop(sid)
+            for gram in self.grams_of(lower):
+                ids = self.grams[gram]
+                ids.discard(sid)
+                if not ids:
+                    del self.grams[gram]
+
+    '''
+    replace the symbols of a module by a list of (name, data)
+    '''
+    def update(self, mod, symbols):
+        self.remove(mod)
+        ids = []
+        for name, data in symbols:
+            sid = self.next_id
+            self.next_id += 1
+            lower = name.lower()
+            self.symbols[sid] = (name, lower, data)
+            for gram in self.grams_of(lower):
+                self.grams.setdefault(gram, set()).add(sid)
+            ids.append(sid)
+        self.modules[mod] = ids
+
+    def lookup(self, grams) -> set:
+        sets = []
+        for gram in grams:
+            ids = self.grams.get(gram)
+            if not ids:
+                return set()
+            sets.append(ids)
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    '''
+    the symbols matching a query as a list of (name, data), best first: an
+    exact match, a prefix, a substring, then a fuzzy match. Shorter names
+    come first within each kind of match
+    '''
+    def search(self, query, limit=100) -> list:
+        query = query.lower()
+        if not query:
+            ret = []
+            for name, _, data in self.symbols.values():
+                if len(ret) >= limit:
+                    break
+                ret.append((name, data))
+            return ret
+        if len(query) >= 3:
+            candidates = self.lookup(query[i:i + 3] for i in range(len(query) - 2))
+        else:
+            candidates = self.lookup(query)
+        ranked = []
+        for sid in candidates:
+            name, lower, _ = self.symbols[sid]
+            pos = lower.find(query)
+            if pos >= 0:
+                ranked.append((0 if lower == query else 1 if pos == 0 else 2, len(name), name, sid))
+        if len(ranked) < limit:
+            found = set(item[3] for item in ranked)
+            pattern = subsequence_pattern(query)
+            for sid in self.lookup(query):
+                name, lower, _ = self.symbols[sid]
+                if sid not in found and pattern.search(lower):
+                    ranked.append((3, len(name), name, sid))
+        return [(self.symbols[sid][0], self.symbols[sid][2]) for _, _, _, sid in heapq.nsmallest(limit, ranked)]
+
+    def __len__(self):
+        return len(self.symbols)
+
+'''
+reverse index of the references: the position of a declaration as
+(source path, line, column) -> the use sites in each module. The references
+of a module are given as a list of [declaration path, line, column, uses],
+each use being [line, column, length], the same list which is stored in the
+cache dir, and are replaced together when the module is compiled again
+'''
+class ReferenceIndex:
+    def __init__(self):
+        self.uses = dict() # (path, line, column) -> dict: module -> (source path, list of uses)
+        self.modules = dict() # module -> list of (path, line, column)
+
+    def remove(self, mod):
+        for decl in self.modules.pop(mod, ()):
+            sites = self.uses[decl]
+            sites.pop(mod, None)
+            if not sites:
+                del self.uses[decl]
+
+    def update(self, mod, path, refs):
+        self.remove(mod)
+        decls = []
+        for decl_path, line, column, uses in refs:
+            decl = (decl_path, line, column)
+            self.uses.setdefault(decl, dict())[mod] = (path, uses)
+            decls.append(decl)
+        self.modules[mod] = decls
+
+    '''
+    the references of a module in the form given to update, or None
+    '''
+    def get(self, mod) -> list:
+        if mod not in self.modules:
+            return None
+        return [[path, line, column, self.uses[(path, line, column)][mod][1]] for path, line, column in self.modules[mod]]
+
+    '''
+    the uses of a declaration as a list of (source path, line, column, length)
+    '''
+    def find(self, decl) -> list:
+        ret = []
+        for path, uses in self.uses.get(decl, dict()).values():
+            for line, column, length in uses:
+                ret.append((path, line, column, length))
+        return ret
+
+    def __contains__(self, mod):
+        return mod in self.modules
+
+    def __len__(self):
+        return len(self.uses)
+
+'''
+the LSP encoding of semantic tokens given as (line, column, length, type,
+modifiers), 0-based. The tokens are sorted, and of the tokens starting at the
+same position only the first one is kept. Each token is encoded relative to
+the previous one as 5 integers
+'''
+def encode_semantic_tokens(tokens) -> list:
+    data = []
+    prev_line = 0
+    prev_column = 0
+    last = None
+    for line, column, length, ty, modifiers in sorted(tokens):
+        if (line, column) == last:
+            continue
+        last = (line, column)
+        data += [line - prev_line, column - prev_column if line == prev_line else column, length, ty, modifiers]
+        prev_line = line
+        prev_column = column
+    return data
+
+'''
+the edit turning the encoded tokens old into new, as (start, delete count,
+data), by skipping their common prefix and suffix. The edit is aligned on
+whole tokens
+'''
+def diff_semantic_tokens(old, new):
+    n = min(len(old), len(new))
+    prefix = 0
+    while prefix < n and old[prefix] == new[prefix]:
+        prefix += 1
+    prefix -= prefix % 5
+    suffix = 0
+    while suffix < n - prefix and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]:
+        suffix += 1
+    suffix -= suffix % 5
+    return prefix, len(old) - prefix - suffix, new[prefix:len(new) - suffix]
+
+'''
+the bodies of the top-level functions of a source, found from the lines where
+its top-level items start in the AST of a successful compile. The body of a
+function is between its declaration line and the last "end" line before the
+next item. skeleton() blanks out the bodies of all the functions but the one
+edited, keeping the line numbers, if all the edits to the source are within
+that body
+'''
+class TopLevelLayout:
+    END = re.compile(r"end\b")
+
+    def __init__(self, source, items):
+        self.lines = source.split("\n")
+        self.bodies = [] # (first line, last line) of each body, 0-based
+        starts = sorted(items)
+        for i, (line, is_function) in enumerate(starts):
+            if not is_function or not self.lines[line].lstrip().startswith("function"):
+                continue
+            limit = starts[i + 1][0] if i + 1 < len(starts) else len(self.lines)
+            for end in range(limit - 1, line, -1):
+                if self.END.match(self.lines[end].strip()):
+                    if end - 1 > line:
+                        self.bodies.append((line + 1, end - 1))
+                    break
+
+    def skeleton(self, source):
+        new = source.split("\n")
+        old = self.lines
+        n = min(len(old), len(new))
+        prefix = 0
+        while prefix < n and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < n - prefix and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]:
+            suffix += 1
+        # the edited lines are old[prefix:len(old) - suffix]
+        edited = None
+        for first, last in self.bodies:
+            if first <= prefix and len(old) - suffix <= last + 1:
+                edited = (first, last)
+                break
+        if edited is None:
+            return None
+        shift = len(new) - len(old)
+        for first, last in self.bodies:
+            if (first, last) == edited:
+                continue
+            if first > edited[1]:
+                first += shift
+                last += shift
+            new[first:last + 1] = [""] * (last - first + 1)
+        return "\n".join(new)
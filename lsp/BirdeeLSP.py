@@ -4,22 +4,132 @@ from pygls.types import *
 from pygls.uris import from_fs_path, to_fs_path
 from urllib.parse import unquote
 import os
+import sys
 from pygls.workspace import Document
 import birdeec
 import math
+import re
 import json
-from threading import Lock
+import hashlib
+from threading import Lock, RLock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import zlib
+import struct
+import time
+import asyncio
+import functools
+import logging
+import logging.handlers
+from contextlib import contextmanager
 import bdutils
 
+def get_lsp_home():
+    home = os.environ.get("BIRDEE_LSP_HOME")
+    if home:
+        return home
+    try:
+        return os.path.dirname(os.path.abspath(__file__))
+    except NameError:
+        return os.getcwd()
+
+lsp_home = get_lsp_home()
+if lsp_home not in sys.path:
+    sys.path.insert(0, lsp_home)
+from BirdeeIndex import PositionIndex, LRUCache, ModuleTrie, LatencyHistogram, parse_imports, find_call_site, BudgetedDict, SymbolIndex, ReferenceIndex, TopLevelLayout, find_near, \
+    encode_semantic_tokens, diff_semantic_tokens
+from BirdeeMetadata import BinaryMetadata, dump_binary_metadata, read_binary_metadata
+from BirdeeReferences import get_member_def_pos, get_member_name, get_ref_target, get_decl_key, collect_references
+
 server = LanguageServer()
 txt = dict()
 root_path = None
 source_root_path = None
 cache_path = None
+compiler_path = None
+pool = None
+
+'''
+records the latency of the request handlers and of the compile phases, and
+counts cache hits. The recent histograms are returned by the birdee/stats
+request, and every sample can be written to a rotating log in the cache dir
+'''
+class Tracer:
+    def __init__(self):
+        self.mutex = Lock()
+        self.histograms = dict() # str(name) -> LatencyHistogram
+        self.counters = dict() # str(name) -> int
+        self.logger = None
+
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        with self.mutex:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = LatencyHistogram()
+                self.histograms[name] = hist
+            hist.add(ms)
+        if self.logger:
+            self.logger.info("%s %.3f", name, ms)
+
+    def count(self, name, n=1):
+        with self.mutex:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def span(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - begin)
+
+    def traced(self, name):
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def enable_log(self, path):
+        if self.logger:
+            return
+        tdir = os.path.dirname(path)
+        if not os.path.exists(tdir):
+            os.makedirs(tdir)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=1024*1024, backupCount=3)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger = logging.getLogger("birdeelsp")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.logger = logger
+
+    def stats(self) -> dict:
+        with self.mutex:
+            latency = {name: hist.summary() for name, hist in self.histograms.items()}
+            counters = dict(self.counters)
+        caches = {"metadata": metadata_cache.stats(), "member_completion": member_completion_cache.stats()}
+        for name in ("compile_cache", "warm_cache", "signature_cache", "binary_metadata", "semantic_tokens", "incremental_compile"):
+            hits = counters.get(name + "_hit", 0)
+            misses = counters.get(name + "_miss", 0)
+            caches[name] = {"hits": hits, "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+        return {"latency_ms": latency, "counters": counters, "caches": caches, "memory": compiler.memory_stats()}
+
+tracer = Tracer()
 
 def dbgprint(s):
-    with open("d:\\birdeelsp.log", "a") as f:
-        f.write(str(s)+"\n")
+    if tracer.logger:
+        tracer.logger.info("%s", s)
 
 def find_module_path(root, mod, ext):
     modname=list(mod)
@@ -30,17 +140,203 @@ def find_module_path(root, mod, ext):
     else:
         return None
 
+def find_source_path(mod):
+    root=os.path.join(root_path, source_root_path)
+    target_path = find_module_path(root, mod,".bdm")
+    if not target_path:
+        target_path = find_module_path(root, mod,".txt")
+    return target_path
+
+def call_in_server_thread(func, *args):
+    server.loop.call_soon_threadsafe(func, *args)
+
+def error_diagnostic(line, pos, msg) -> Diagnostic:
+    return Diagnostic(Range(
+        Position(line, pos+1), Position(line, pos+2)
+    ), msg)
+
+def get_cache_root():
+    if root_path is None or cache_path is None:
+        return None
+    return os.path.join(root_path, cache_path)
+
+def get_cache_file(mod, ext):
+    root = get_cache_root()
+    if not root:
+        return None
+    modname=list(mod)
+    modname[-1] = modname[-1] + ext
+    return os.path.join(root, *modname)
+
+def write_file_atomic(target_path, content):
+    tdir = os.path.dirname(target_path)
+    if not os.path.exists(tdir):
+        os.makedirs(tdir)
+    tmp_path = target_path + ".tmp"
+    with open(tmp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, target_path)
+
+def source_hash(istr: str) -> str:
+    return hashlib.sha1(istr.encode("utf-8")).hexdigest()
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+'''
+whether the source file has the given hash, i.e. a module compiled from an
+editor buffer has no unsaved changes
+'''
+def source_on_disk(path, src_hash) -> bool:
+    try:
+        with open(path) as f:
+            return source_hash(f.read()) == src_hash
+    except OSError:
+        return False
+
+class ModuleNode:
+    def __init__(self, path, imports, src_hash, mtime=None, on_disk=True):
+        self.path = path
+        self.imports = imports # set(tuple[module_names])
+        self.hash = src_hash
+        self.mtime = mtime if mtime is not None or not path else get_mtime(path)
+        # False if compiled from an unsaved buffer, then it is not persisted
+        self.on_disk = on_disk
+        # the hash of the last compile from the file on disk, which the dependents
+        # are invalidated against
+        self.saved_hash = src_hash if on_disk else None
+
+class ModuleGraph:
+    def __init__(self):
+        self.nodes = dict() # tuple[module_names] -> ModuleNode
+        self.dependents = dict() # tuple[module_names] -> set(tuple[module_names])
+
+    '''
+    record the imports and the source hash of a freshly compiled module.
+    Returns True if the module was known before and its file on disk has
+    changed. A compile of an unsaved buffer is not a change until it is saved
+    '''
+    def update(self, mod, path, imports, src_hash, on_disk=True) -> bool:
+        old = self.nodes.get(mod)
+        if old:
+            for dep in old.imports:
+                self.dependents.get(dep, set()).discard(mod)
+        for dep in imports:
+            self.dependents.setdefault(dep, set()).add(mod)
+        node = self.nodes[mod] = ModuleNode(path, set(imports), src_hash, on_disk=on_disk)
+        if not old:
+            return False
+        saved_hash = old.saved_hash if old.saved_hash is not None else old.hash
+        if not on_disk:
+            node.saved_hash = saved_hash
+            return False
+        return saved_hash != src_hash
+
+    def restore(self, mod, node: ModuleNode):
+        for dep in node.imports:
+            self.dependents.setdefault(dep, set()).add(mod)
+        self.nodes[mod] = node
+
+    '''
+    check whether the source file of a module has changed on disk since it
+    was compiled. The mtime is checked first and the file is only re-hashed
+    when the mtime differs
+    '''
+    def is_stale(self, mod) -> bool:
+        node = self.nodes.get(mod)
+        if not node or not node.path:
+            return False
+        mtime = get_mtime(node.path)
+        if mtime == node.mtime:
+            return False
+        if mtime is None:
+            return True
+        with open(node.path) as f:
+            src_hash = source_hash(f.read())
+        if src_hash != node.hash:
+            return True
+        node.mtime = mtime
+        node.on_disk = True
+        return False
+
+    '''
+    the module and all modules that transitively depend on it, ordered so that
+    every module comes after the modules it imports
+    '''
+    def affected(self, mod) -> list:
+        seen = {mod}
+        stack = [mod]
+        while stack:
+            cur = stack.pop()
+            for dep in self.dependents.get(cur, ()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        order = []
+        for level in self.topological_levels(seen):
+            order.extend(level)
+        return order
+
+    '''
+    split a set of modules into levels, where the modules of a level only
+    import modules of the previous levels (or modules out of the set). The
+    modules of a level can be compiled in parallel
+    '''
+    def topological_levels(self, mods) -> list:
+        mods = set(mods)
+        indegree = dict()
+        for m in mods:
+            node = self.nodes.get(m)
+            indegree[m] = len(node.imports & mods) if node else 0
+        ready = sorted(m for m in mods if indegree[m] == 0)
+        levels = []
+        done = set()
+        while ready:
+            levels.append(ready)
+            done.update(ready)
+            next_ready = []
+            for cur in ready:
+                for dep in self.dependents.get(cur, ()):
+                    if dep in indegree:
+                        indegree[dep] -= 1
+                        if indegree[dep] == 0:
+                            next_ready.append(dep)
+            ready = sorted(next_ready)
+        # modules in an import cycle never reach indegree 0
+        rest = sorted(m for m in mods if m not in done)
+        if rest:
+            levels.append(rest)
+        return levels
+
 class Compiler:
     def __init__(self):
         self.mutex = Lock()
         self.uri=None
         self.last_status = False
+        self.last_diagnostics = []
+        self.pos_index = None # PositionIndex of the current compile unit, built on demand
+        self.pos_queried = False # whether a position was looked up in the current compile unit
         self.last_compiled_source = None
         self.last_successful_source = dict() # str(uri) -> str(source)
-        self.module_metadata = dict() # tuple[module_names] -> str(json)
+        # str(uri) -> (source, [(line, is_function)] of the top-level items) of the
+        # last successful compile, replaced by its TopLevelLayout when first needed
+        self.layouts = dict()
+        # tuple[module_names] -> str(json). The cold modules beyond the budget are
+        # evicted to their .bmm in the cache dir and reloaded by load_cached
+        self.module_metadata = BudgetedDict()
+        self.graph = ModuleGraph()
+        self.changed_modules = [] # modules whose file on disk changed, until take_invalidated
+        self.persisted = dict() # tuple[module_names] -> source hash of the .bmm in the cache dir
+        # guards module_metadata and graph, which are also updated by the compile workers
+        self.meta_mutex = RLock()
 
     def __enter__(self):
+        begin = time.perf_counter()
         self.mutex.acquire()
+        tracer.record("lock_wait", time.perf_counter() - begin)
 
     def __exit__(self, ty, value, traceback):
         self.mutex.release()
@@ -51,87 +347,391 @@ class Compiler:
         else:
             birdeec.clear_compile_unit()
 
+    def has_module(self, mod) -> bool:
+        with self.meta_mutex:
+            return mod in self.module_metadata or self.load_cached(mod)
+
+    def store_module(self, mod, fspath, imports, src_hash, metadata, refs=None, on_disk=True):
+        with self.meta_mutex:
+            if mod not in self.module_metadata:
+                module_index.add(mod, "memory")
+            self.module_metadata[mod] = metadata
+            if self.graph.update(mod, fspath, imports, src_hash, on_disk):
+                self.invalidate(mod)
+                self.module_metadata[mod] = metadata
+                if mod not in self.changed_modules:
+                    self.changed_modules.append(mod)
+            if refs is not None:
+                reference_index.update(mod, fspath, refs)
+            self.persist(mod)
+            self.evict_metadata()
+        symbol_index.mark(mod)
+
+    '''
+    drop the metadata of a module and of every module depending on it.
+    Returns the invalidated modules in topological order
+    '''
+    def invalidate(self, mod) -> list:
+        order = self.graph.affected(mod)
+        for m in order:
+            self.module_metadata.pop(m, None)
+            reference_index.remove(m)
+            self.drop_cached(m)
+        return order
+
+    '''
+    write-through persistence of a module's metadata to the cache dir. The
+    .bdep file next to the .bmm records the source path, the source hash and
+    the hashes of the imported modules, which are used to validate the .bmm
+    on the next launch. A module compiled from an unsaved buffer, or against
+    one, is not persisted: the entry of its file on disk is kept. The .bref
+    holds the references of the module
+    '''
+    def persist(self, mod):
+        node = self.graph.nodes.get(mod)
+        if mod not in self.module_metadata or not node or not node.on_disk:
+            return
+        if self.persisted.get(mod) == node.hash:
+            return
+        bmm_path = get_cache_file(mod, ".bmm")
+        if not bmm_path:
+            return
+        imports = []
+        for dep in node.imports:
+            dep_node = self.graph.nodes.get(dep)
+            if dep_node and not dep_node.on_disk:
+                return
+            imports.append([".".join(dep), dep_node.hash if dep_node else None])
+        dep_info = {"path": node.path, "hash": node.hash, "mtime": node.mtime, "imports": imports}
+        refs = reference_index.get(mod)
+        try:
+            write_file_atomic(bmm_path, self.module_metadata[mod])
+            write_file_atomic(get_cache_file(mod, ".bdep"), json.dumps(dep_info))
+            if refs is not None:
+                write_file_atomic(get_cache_file(mod, ".bref"), json.dumps({"hash": node.hash, "refs": refs}))
+            self.persisted[mod] = node.hash
+        except OSError:
+            pass
+
+    def drop_cached(self, mod):
+        self.persisted.pop(mod, None)
+        for ext in (".bdep", ".bmm", ".bmx", ".bref"):
+            target_path = get_cache_file(mod, ext)
+            if target_path and os.path.exists(target_path):
+                try:
+                    os.remove(target_path)
+                except OSError:
+                    pass
+
+    '''
+    warm start: seed the in-memory metadata of a module from the cache dir.
+    The cached .bmm is used only if the source file is unchanged (by mtime,
+    then by hash) and all the imported modules it was compiled against are
+    still valid. The imports are walked with an explicit stack, an import
+    chain may be deeper than the recursion limit. Returns True if the module
+    is now in memory
+    '''
+    def load_cached(self, mod) -> bool:
+        if mod in self.module_metadata:
+            return True
+        dep_info = self.read_cached_deps(mod)
+        if dep_info is None:
+            return False
+        # the modules being loaded: [module, .bdep info, index of the next import, expected hash]
+        stack = [[mod, dep_info, 0, None]]
+        # only the modules being loaded form a cycle, a module loaded before
+        # may have been evicted since then and can be loaded again
+        loading = {mod}
+        try:
+            while stack:
+                frame = stack[-1]
+                cur, dep_info, idx, _ = frame
+                imports = dep_info["imports"]
+                if idx < len(imports):
+                    frame[2] += 1
+                    name, dep_hash = imports[idx]
+                    if dep_hash is None:
+                        continue
+                    dep = tuple(name.split("."))
+                    # an evicted module is checked without loading its metadata
+                    if dep in self.module_metadata or (self.is_evicted(dep) and not self.graph.is_stale(dep)):
+                        dep_node = self.graph.nodes.get(dep)
+                        if not dep_node or dep_node.hash != dep_hash:
+                            return False
+                        continue
+                    if dep in loading:
+                        return False
+                    dep_deps = self.read_cached_deps(dep)
+                    if dep_deps is None:
+                        return False
+                    stack.append([dep, dep_deps, 0, dep_hash])
+                    loading.add(dep)
+                    continue
+                with open(get_cache_file(cur, ".bmm")) as f:
+                    metadata = f.read()
+                stack.pop()
+                loading.discard(cur)
+                imports = set(tuple(name.split(".")) for name, _ in dep_info["imports"])
+                self.graph.restore(cur, ModuleNode(dep_info["path"], imports, dep_info["hash"], dep_info["mtime"]))
+                self.module_metadata[cur] = metadata
+                self.persisted[cur] = dep_info["hash"]
+                tracer.count("warm_cache_hit")
+                self.evict_metadata()
+                if frame[3] is not None and frame[3] != dep_info["hash"]:
+                    return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    '''
+    read the .bdep of a module in the cache dir and check that its source file
+    is unchanged. Returns None if the cached module cannot be used
+    '''
+    def read_cached_deps(self, mod) -> dict:
+        bdep_path = get_cache_file(mod, ".bdep")
+        if not bdep_path or not os.path.exists(bdep_path):
+            tracer.count("warm_cache_miss")
+            return None
+        try:
+            with open(bdep_path) as f:
+                dep_info = json.load(f)
+            path = dep_info["path"]
+            if path:
+                cur_mtime = get_mtime(path)
+                if cur_mtime is None:
+                    return None
+                if cur_mtime != dep_info["mtime"]:
+                    with open(path) as f:
+                        if source_hash(f.read()) != dep_info["hash"]:
+                            return None
+                    dep_info["mtime"] = cur_mtime
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return dep_info
+
+    '''
+    only a module whose .bmm in the cache dir is up to date can be evicted,
+    so that load_cached can bring it back
+    '''
+    def is_evicted(self, mod) -> bool:
+        node = self.graph.nodes.get(mod)
+        return mod not in self.module_metadata and node is not None and self.persisted.get(mod) == node.hash
+
+    def evict_metadata(self):
+        def can_evict(mod):
+            node = self.graph.nodes.get(mod)
+            return node is not None and self.persisted.get(mod) == node.hash
+        evicted = self.module_metadata.evict(can_evict)
+        if evicted:
+            tracer.count("metadata_evicted", len(evicted))
+
+    def set_metadata_budget(self, budget):
+        with self.meta_mutex:
+            self.module_metadata.budget = budget
+            self.evict_metadata()
+
+    '''
+    drop the state kept for a closed document
+    '''
+    def forget(self, uri):
+        with self.meta_mutex:
+            self.last_successful_source.pop(uri, None)
+            self.layouts.pop(uri, None)
+
+    def memory_stats(self) -> dict:
+        with self.meta_mutex:
+            sources = sum(len(src) for src in self.last_successful_source.values())
+            return {"documents": len(txt), "last_successful_source": {"entries": len(self.last_successful_source),
+                "size": sources}, "module_metadata": self.module_metadata.stats()}
+
+    '''
+    recompile the modules invalidated by a change of their dependencies. The
+    modules are compiled dependencies-first so that each of them is compiled
+    only once
+    '''
+    def take_invalidated(self) -> list:
+        with self.meta_mutex:
+            changed = self.changed_modules
+            self.changed_modules = []
+            order = []
+            for mod in changed:
+                for m in self.graph.affected(mod):
+                    if m not in order and m not in changed:
+                        order.append(m)
+            ret = []
+            for mod in order:
+                node = self.graph.nodes.get(mod)
+                if mod in self.module_metadata or not node or not node.path or not os.path.exists(node.path):
+                    continue
+                ret.append(node.path)
+            return ret
+
+    def recompile_invalidated(self):
+        paths = self.take_invalidated()
+        if not paths:
+            return
+        for path in paths:
+            with open(path) as f:
+                src = f.read()
+            self._docompile(path, src)
+        # the compile unit now holds the last dependent module
+        self.uri = None
+
     def on_exit(self):
         for mod in self.module_metadata:
-            modname=list(mod)
-            modname[-1] = modname[-1] + ".bmm"
-            target_path = os.path.join(root_path, cache_path, *modname)
-            tdir = os.path.dirname(target_path)
-            if not os.path.exists(tdir):
-                os.makedirs(tdir)
-            with open(target_path, 'w') as f:
-                f.write(self.module_metadata[mod])
+            self.persist(mod)
+
+    '''
+    compile a module once. Returns the error, the (module, source path) of the
+    imported modules which are not compiled but have their source in the
+    workspace, and whether all the uncompiled imports have a source. The
+    module is stored only if store is set
+    '''
+    def _compile_once(self, fspath, istr, store=True):
+        src_hash = source_hash(istr)
+        can_recompile=True
+        dependencies=[]
+        imports=set()
+        def _module_resolver(modname, second_chance):
+            tmod = tuple(modname)
+            nonlocal can_recompile
+            if not second_chance:
+                imports.add(tmod)
+                with self.meta_mutex:
+                    if tmod in self.module_metadata and self.graph.is_stale(tmod):
+                        self.invalidate(tmod)
+                    if self.has_module(tmod):
+                        return ("$InMemoryModule", self.module_metadata[tmod])
+                return None
+            else:
+                target_path = find_source_path(modname)
+                if target_path:
+                    dependencies.append((tmod, target_path))
+                else:
+                    can_recompile=False
+                return None
+        e = None
+        birdeec.set_module_resolver(_module_resolver)
+        try:
+            birdeec.set_source_file_path(fspath)
+            birdeec.clear_compile_unit()
+            with tracer.span("top_level"):
+                birdeec.top_level(istr)
+            with tracer.span("process_top_level"):
+                birdeec.process_top_level()
+        except birdeec.TokenizerException:
+            e=birdeec.get_tokenizer_error()
+        except birdeec.CompileException:
+            e=birdeec.get_compile_error()
+        if not e and store:
+            cur_module = tuple(birdeec.get_module_name().split("."))
+            with tracer.span("get_metadata_json"):
+                metadata = birdeec.get_metadata_json()
+            with tracer.span("collect_references"):
+                refs = collect_references(fspath)
+            self.store_module(cur_module, fspath, imports, src_hash, metadata, refs,
+                source_on_disk(fspath, src_hash))
+        return e, dependencies, can_recompile
 
     '''
     compile a module and its dependencies:
         if it has any uncompiled modules that we can find source in the workspace,
         compile it. Then get and store the dependencies' BMM metadata in memory.
         Then re-compile the module
+    The modules waiting for their dependencies are kept in a stack instead of
+    recursing, because the import chains of a workspace can be thousands of
+    modules deep. A dependency already on the stack is an import cycle
     '''
     def _docompile(self, fspath, istr):
-        def compileit():
-            e = None
-            birdeec.set_module_resolver(_module_resolver)
-            try:
-                birdeec.set_source_file_path(fspath)
-                birdeec.clear_compile_unit()
-                birdeec.top_level(istr)
-                birdeec.process_top_level()
-            except birdeec.TokenizerException:
-                e=birdeec.get_tokenizer_error()
-            except birdeec.CompileException:
-                e=birdeec.get_compile_error()
-            if not e:
-                cur_module = tuple(birdeec.get_module_name().split("."))
-                self.module_metadata[cur_module] = birdeec.get_metadata_json()
-            return e
-
-        while True:
-            e=None
-            can_recompile=True
-            dependencies=[]
-            def _module_resolver(modname, second_chance):
-                tmod = tuple(modname)
-                nonlocal can_recompile
-                if not second_chance:
-                    if tmod in self.module_metadata:
-                        return ("$InMemoryModule", self.module_metadata[tmod])
-                    else:
-                        return None
-                else:
-                    root=os.path.join(root_path, source_root_path)
-                    target_path = find_module_path(root, modname,".bdm")
-                    if not target_path:
-                        target_path = find_module_path(root, modname,".txt")
-                    if target_path:
-                        dependencies.append((tmod, target_path))
-                    else:
-                        can_recompile=False
-                    return None
-            e = compileit()
-            if not e:
-                return e
+        # the AST nodes in the index belong to the compile unit to be cleared
+        self.reset_position_index()
+        e = None
+        stack = [(None, fspath, istr)] # (module, source path, source)
+        compiling = {os.path.normpath(fspath)} # the source paths on the stack
+        while stack:
+            mod, path, src = stack[-1]
+            if mod is not None and mod in self.module_metadata:
+                # a dependency may be compiled in another dependency
+                stack.pop()
+                compiling.discard(os.path.normpath(path))
+                continue
+            if len(stack) == 1:
+                e, dependencies, can_recompile = self._compile_once(path, src)
+                sub_e = e
+            else:
+                with tracer.span("dependency_compile"):
+                    sub_e, dependencies, can_recompile = self._compile_once(path, src)
+            if not sub_e:
+                stack.pop()
+                compiling.discard(os.path.normpath(path))
+                continue
             if not can_recompile or len(dependencies)==0:
+                if len(stack) > 1:
+                    msg = "While compiling {}, an error occurs: {}".format(path, sub_e.msg)
+                    call_in_server_thread(server.show_message, msg, MessageType.Error)
                 return e
             # can re-compile
             # first compile dependencies
-            for (mod,srcpath) in dependencies:
-                if mod in self.module_metadata: 
-                    # a dependency may be compiled in another dependency
-                    continue
-                src = ""
-                with open(srcpath) as f:
-                    src = f.read()
-                sub_e = self._docompile(srcpath, src)
-                if sub_e:
-                    msg = "While compiling {}, an error occurs: {}".format(srcpath, sub_e.msg)
-                    server.show_message(msg, MessageType.Error)
+            pending = []
+            for (dep, srcpath) in dependencies:
+                if os.path.normpath(srcpath) in compiling:
+                    msg = "While compiling {}, an error occurs: import cycle through {}".format(path, srcpath)
+                    call_in_server_thread(server.show_message, msg, MessageType.Error)
+                    return e
+                if dep not in self.module_metadata and srcpath not in [p for _, p in pending]:
+                    pending.append((dep, srcpath))
+            if pool:
+                with tracer.span("dependency_compile"):
+                    errors = pool.compile_many([srcpath for _, srcpath in pending], os.path.normpath(path))
+                for srcpath, msg in errors:
+                    msg = "While compiling {}, an error occurs: {}".format(srcpath, msg)
+                    call_in_server_thread(server.show_message, msg, MessageType.Error)
                     return e
+                continue
+            for (dep, srcpath) in pending:
+                with open(srcpath) as f:
+                    stack.append((dep, srcpath, f.read()))
+                compiling.add(os.path.normpath(srcpath))
         return e
 
-    def compile(self, uri, istr) -> bool:
+    def reset_position_index(self):
+        self.pos_index = None
+        self.pos_queried = False
+
+    '''
+    the AST nodes near a 1-based position of the last compiled source. Most
+    compiles are never queried or queried once, so the first lookup walks the
+    top-level items around the line and the index is only built when a second
+    lookup hits the same compile
+    '''
+    def find_nodes(self, line, column, line_length) -> list:
+        if self.pos_index is None and not self.pos_queried:
+            self.pos_queried = True
+            return find_near(birdeec.get_top_level(), line, column, line_length)
+        return self.get_position_index().find(line, column, line_length)
+
+    '''
+    the position index of the last compiled source. It stays valid as long as
+    compile() is called again with the same source, which does not recompile
+    '''
+    def get_position_index(self) -> PositionIndex:
+        if self.pos_index is None:
+            index = PositionIndex()
+            def runfunc(ast: birdeec.StatementAST):
+                if not ast:
+                    return
+                index.add(ast.pos.line, ast.pos.pos, ast)
+                ast.run(runfunc)
+            for a in birdeec.get_top_level():
+                runfunc(a)
+            self.pos_index = index.finish()
+        return self.pos_index
+
+    def compile(self, uri, istr, publish=True) -> bool:
         if self.uri == uri and istr == self.last_compiled_source:
+            tracer.count("compile_cache_hit")
             return self.last_status
+        tracer.count("compile_cache_miss")
 
         self.last_compiled_source = istr
         fspath=to_fs_path(uri)
@@ -141,62 +741,491 @@ class Compiler:
         if not e:
             self.last_status=True
             self.last_successful_source[uri] = istr
-            server.publish_diagnostics(uri, [])
+            self.layouts[uri] = (istr, [(a.pos.line - 1, isinstance(a, birdeec.FunctionAST))
+                for a in birdeec.get_top_level() if a])
+            self.last_diagnostics = []
+            if publish:
+                call_in_server_thread(server.publish_diagnostics, uri, [])
             return True
         else:
             self.last_status=False
-            if not birdeec.get_auto_completion_ast():
-                diag = Diagnostic(Range(
-                    Position(e.linenumber, e.pos+1), Position(e.linenumber, e.pos+2)
-                ), e.msg)
-                server.publish_diagnostics(uri, [diag])
+            self.last_diagnostics = [error_diagnostic(e.linenumber, e.pos, e.msg)]
+            if publish and not birdeec.get_auto_completion_ast():
+                call_in_server_thread(server.publish_diagnostics, uri, self.last_diagnostics)
             return False
 
+    '''
+    compile a document with the completion marker of a completion or signature
+    help request. If all the edits since the last successful compile of the
+    document are within the body of one top-level function, the bodies of the
+    other top-level functions are blanked out, so that only that function is
+    analyzed against the declarations of the rest of the file. Such a compile
+    does not store the module. Otherwise, or if it does not reach the marker,
+    the whole document is compiled
+    '''
+    def compile_for_completion(self, uri, istr) -> bool:
+        layout = self.layouts.get(uri)
+        if isinstance(layout, tuple):
+            layout = self.layouts[uri] = TopLevelLayout(*layout)
+        src = layout.skeleton(istr) if layout else None
+        if src is None:
+            tracer.count("incremental_compile_miss")
+            return self.compile(uri, istr)
+        if self.uri == uri and src == self.last_compiled_source:
+            tracer.count("compile_cache_hit")
+            return self.last_status
+        self.reset_position_index()
+        self.uri = uri
+        self.last_compiled_source = src
+        with tracer.span("incremental_compile"):
+            e, dependencies, _ = self._compile_once(to_fs_path(uri), src, store=False)
+        if dependencies or (e and not birdeec.get_auto_completion_ast()):
+            tracer.count("incremental_compile_miss")
+            return self.compile(uri, istr)
+        tracer.count("incremental_compile_hit")
+        self.last_status = not e
+        return self.last_status
+
 compiler = Compiler()
 
+WORKER_MARKER = "@@BIRDEE_WORKER@@ "
+
+'''
+a birdeec process running BirdeeWorker.py. Requests to the same worker are
+serialized, and the worker remembers the metadata it has been sent, so only
+new or changed module metadata is sent with a request
+'''
+class CompileWorker:
+    def __init__(self, command):
+        self.command = command
+        self.mutex = Lock()
+        self.next_id = 0
+        self.proc = None
+        self.sent = dict() # tuple[module_names] -> source hash of the metadata sent
+        self.start()
 
+    def start(self):
+        self.sent = dict()
+        env = dict(os.environ)
+        env["BIRDEE_LSP_HOME"] = lsp_home
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1, env=env)
 
-def find_ast_by_pos(pos: Position, line_length: int):
-    tl = birdeec.get_top_level()
-    res=[]
-    def runfunc(ast: birdeec.StatementAST):
-        if not ast:
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+
+    def _snapshot(self, names):
+        metadata = dict()
+        known = []
+        with compiler.meta_mutex:
+            for mod in names:
+                if not compiler.has_module(mod):
+                    continue
+                name = ".".join(mod)
+                node = compiler.graph.nodes.get(mod)
+                version = node.hash if node else None
+                if version is not None and self.sent.get(mod) == version:
+                    known.append(name)
+                else:
+                    metadata[name] = compiler.module_metadata[mod]
+                    self.sent[mod] = version
+        return metadata, known
+
+    def compile(self, path, source, names) -> dict:
+        with self.mutex:
+            metadata, known = self._snapshot(names)
+            self.next_id += 1
+            req = {"id": self.next_id, "path": path, "source": source, "metadata": metadata, "known": known}
+            try:
+                self.proc.stdin.write(json.dumps(req) + "\n")
+                self.proc.stdin.flush()
+                for line in self.proc.stdout:
+                    if line.startswith(WORKER_MARKER):
+                        return json.loads(line[len(WORKER_MARKER):])
+            except (OSError, ValueError):
+                pass
+            self.close()
+            self.start()
+            return {"id": req["id"], "imports": [], "missing": [],
+                "error": {"line": 0, "pos": 0, "msg": "The compile worker exited unexpectedly"}}
+
+'''
+a compile of a module from its source file, shared by all the compiles
+needing the module. It is run by the pool's executor or, if it has not
+started yet, by the first thread waiting for it
+'''
+class PoolTask:
+    def __init__(self, path):
+        self.path = path
+        self.claimed = False
+        self.error = None # the error message
+        self.done = Event()
+
+'''
+a pool of compile workers, each one owning its own birdeec compile unit.
+Documents are dispatched to workers by path affinity, and the dependencies
+found missing by a worker are compiled in parallel on the pool
+'''
+class CompilerPool:
+    def __init__(self, command, size):
+        self.workers = [CompileWorker(command) for _ in range(size)]
+        self.executor = ThreadPoolExecutor(size)
+        self.last_imports = dict() # str(path) -> list(tuple[module_names])
+        self.mutex = Lock()
+        self.in_flight = dict() # normalized path -> PoolTask
+        # normalized path -> {normalized path: count} of the compiles it waits for.
+        # A wait closing a cycle is an import cycle
+        self.waits = dict()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for worker in self.workers:
+            worker.close()
+
+    def worker_for(self, path) -> CompileWorker:
+        return self.workers[zlib.crc32(path.encode("utf-8")) % len(self.workers)]
+
+    '''
+    compile a module on a worker, compiling its uncompiled workspace
+    dependencies first. Returns None on success or the error dict
+    '''
+    def compile(self, path, source) -> dict:
+        key = os.path.normpath(path)
+        src_hash = source_hash(source)
+        worker = self.worker_for(path)
+        names = set(self.last_imports.get(path, ()))
+        while True:
+            with tracer.span("worker_compile"):
+                resp = worker.compile(path, source, names)
+            imports = [tuple(name.split(".")) for name in resp["imports"]]
+            if imports:
+                self.last_imports[path] = imports
+            if "error" not in resp:
+                compiler.store_module(tuple(resp["module"].split(".")), path, imports, src_hash, resp["metadata"],
+                    resp.get("references"), source_on_disk(path, src_hash))
+                return None
+            missing = [tuple(name.split(".")) for name in resp["missing"]]
+            pending = []
+            progress = False
+            for mod in missing:
+                if compiler.has_module(mod):
+                    progress = progress or mod not in names
+                    continue
+                srcpath = find_source_path(mod)
+                if not srcpath:
+                    return resp["error"]
+                if srcpath not in pending:
+                    pending.append(srcpath)
+            if not pending and not progress:
+                return resp["error"]
+            for srcpath, msg in self.compile_many(pending, key):
+                return {"line": 0, "pos": 0, "msg": "While compiling {}, an error occurs: {}".format(srcpath, msg)}
+            names.update(imports)
+            names.update(missing)
+
+    def waits_for(self, key, target) -> bool:
+        seen = set()
+        stack = [key]
+        while stack:
+            cur = stack.pop()
+            if cur == target:
+                return True
+            if cur not in seen:
+                seen.add(cur)
+                stack.extend(self.waits.get(cur, ()))
+        return False
+
+    def run_task(self, task: PoolTask):
+        with self.mutex:
+            if task.claimed:
+                return
+            task.claimed = True
+        try:
+            with open(task.path) as f:
+                src = f.read()
+            e = self.compile(task.path, src)
+            if e:
+                task.error = e["msg"]
+        except OSError as ex:
+            task.error = str(ex)
+        finally:
+            with self.mutex:
+                self.in_flight.pop(os.path.normpath(task.path), None)
+            task.done.set()
+
+    '''
+    compile modules from their source files in parallel on the executor. A
+    module already being compiled is waited for instead of compiled again.
+    waiter is the normalized path of the module needing them, if any. Returns
+    the list of (path, error message) of the modules failed to compile
+    '''
+    def compile_many(self, paths, waiter=None) -> list:
+        errors = []
+        tasks = []
+        for path in paths:
+            key = os.path.normpath(path)
+            with self.mutex:
+                if waiter is not None and self.waits_for(key, waiter):
+                    errors.append((path, "import cycle through {}".format(waiter)))
+                    continue
+                task = self.in_flight.get(key)
+                if task is None:
+                    task = self.in_flight[key] = PoolTask(path)
+                    self.executor.submit(self.run_task, task)
+                if waiter is not None:
+                    targets = self.waits.setdefault(waiter, dict())
+                    targets[key] = targets.get(key, 0) + 1
+            tasks.append(task)
+        try:
+            for task in tasks:
+                # a task not started yet is run here, so waiting never needs a free thread
+                self.run_task(task)
+                task.done.wait()
+                if task.error:
+                    errors.append((task.path, task.error))
+        finally:
+            if waiter is not None:
+                with self.mutex:
+                    targets = self.waits.get(waiter, dict())
+                    for task in tasks:
+                        key = os.path.normpath(task.path)
+                        targets[key] -= 1
+                        if not targets[key]:
+                            del targets[key]
+                    if not targets:
+                        self.waits.pop(waiter, None)
+        return errors
+
+    def compile_document(self, uri, source, recompile_dependents=False, is_current=None):
+        e = self.compile(to_fs_path(uri), source)
+        if is_current and not is_current():
             return
-        if ast.pos.line == pos.line + 1 and ast.pos.pos >= pos.character + 1:
-            res.append((ast.pos.pos - pos.character - 1, ast))
-        if ast.pos.line == pos.line + 2 and ast.pos.pos == 1:
-            res.append((line_length - pos.character - 1, ast)) 
-            #Birdee compiler marks the end of the expression, maybe in the next line
-        ast.run(runfunc)
-    have_candidate=False
-    for idx, a in enumerate(tl):
-        if a.pos.line >=  pos.line:
-            if idx>0: runfunc(tl[idx-1])
-            if idx>1: runfunc(tl[idx-2])
-            runfunc(tl[idx])
-            if idx+1 < len(tl): runfunc(tl[idx+1])
-            have_candidate=True
-            break
-    if not have_candidate:
-        runfunc(tl[len(tl)-1])
-    return sorted(res,  key=lambda x: x[0])
+        if e:
+            call_in_server_thread(server.publish_diagnostics, uri, [error_diagnostic(e["line"], e["pos"], e["msg"])])
+            return
+        with compiler.meta_mutex:
+            compiler.last_successful_source[uri] = source
+        call_in_server_thread(server.publish_diagnostics, uri, [])
+        if recompile_dependents:
+            for path in compiler.take_invalidated():
+                with open(path) as f:
+                    src = f.read()
+                self.compile(path, src)
+
+    def submit_document(self, uri, source, recompile_dependents=False):
+        self.executor.submit(self.compile_document, uri, source, recompile_dependents)
+
+def start_pool(size):
+    global pool
+    if pool or size <= 0:
+        return
+    worker_script = os.path.join(lsp_home, "BirdeeWorker.py")
+    command = compiler_path
+    if not command:
+        BIRDEE_HOME=os.environ.get('BIRDEE_HOME')
+        if not BIRDEE_HOME:
+            return
+        command = os.path.join(BIRDEE_HOME, "bin", "birdeec")
+    args = [command, "-s", "-i", worker_script, "-o", "111.obj"]
+    cache_root = get_cache_root()
+    if cache_root:
+        args += ["-l", cache_root]
+    try:
+        pool = CompilerPool(args, size)
+    except OSError as ex:
+        server.show_message("Cannot start the compile workers: {}".format(ex), MessageType.Warning)
+
+'''
+sends window/workDoneProgress notifications from any thread
+'''
+class Progress:
+    def __init__(self, token, title):
+        self.token = token
+        call_in_server_thread(server.lsp.send_request, "window/workDoneProgress/create", {"token": token})
+        self.notify({"kind": "begin", "title": title, "cancellable": False, "percentage": 0})
+
+    def notify(self, value):
+        call_in_server_thread(server.send_notification, "$/progress", {"token": self.token, "value": value})
+
+    def report(self, message, percentage):
+        self.notify({"kind": "report", "message": message, "percentage": percentage})
+
+    def end(self, message):
+        self.notify({"kind": "end", "message": message})
+
+'''
+precompiles every module under sourceRoot in the background, leaf modules
+first, so that the metadata of the dependencies is in memory before a
+document needs it. The dependency graph is built from the import lines of the
+sources, without compiling them
+'''
+class WorkspaceIndexer:
+    def __init__(self):
+        self.started = False
+
+    def find_sources(self) -> dict:
+        root = os.path.join(root_path, source_root_path)
+        sources = dict() # tuple[module_names] -> str(path)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            rel = os.path.relpath(dirpath, root)
+            prefix = () if rel == "." else tuple(rel.split(os.sep))
+            for fname in filenames:
+                base, ext = os.path.splitext(fname)
+                if ext == ".bdm" or (ext == ".txt" and prefix + (base,) not in sources):
+                    sources[prefix + (base,)] = os.path.join(dirpath, fname)
+        return sources
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        sources = self.find_sources()
+        graph = ModuleGraph()
+        for mod, path in sources.items():
+            try:
+                with open(path) as f:
+                    imports = [dep for dep in parse_imports(f.read()) if dep in sources]
+            except OSError:
+                continue
+            graph.restore(mod, ModuleNode(path, set(imports), None))
+        levels = graph.topological_levels(graph.nodes)
+        progress = Progress("birdee-indexer", "Indexing Birdee modules")
+        total = len(graph.nodes)
+        done = 0
+        failed = 0
+        for level in levels:
+            paths = [sources[mod] for mod in level if not compiler.has_module(mod)]
+            done += len(level) - len(paths)
+            if pool:
+                failed += len(pool.compile_many(paths))
+                done += len(paths)
+                progress.report("{}/{}".format(done, total), done * 100 // max(total, 1))
+            else:
+                for path in paths:
+                    try:
+                        with open(path) as f:
+                            src = f.read()
+                    except OSError:
+                        failed += 1
+                        continue
+                    # let the requests run between the modules
+                    with compiler:
+                        if compiler._docompile(path, src):
+                            failed += 1
+                        compiler.uri = None
+                    done += 1
+                    progress.report("{}/{}".format(done, total), done * 100 // max(total, 1))
+        progress.end("Indexed {} modules, {} failed".format(total, failed))
+
+indexer = WorkspaceIndexer()
+
+'''
+the compiles of the request handlers run on this thread, so that the event
+loop keeps applying edits and cancellations while birdeec is working. If the
+request is cancelled before the function starts, it never runs
+'''
+compile_executor = ThreadPoolExecutor(1)
+
+async def run_compiler(func, *args):
+    return await server.loop.run_in_executor(compile_executor, func, *args)
+
+async def run_io(func, *args):
+    return await server.loop.run_in_executor(None, func, *args)
+
+'''
+compiles the edited documents in the background. Bursts of changes are
+coalesced by restarting a debounce timer on every change, and only the latest
+version of a document is compiled. A compile whose document has been changed
+again while it was waiting for the compiler, or while it was running, is
+dropped without publishing its diagnostics
+'''
+class DiagnosticsScheduler:
+    def __init__(self):
+        self.delay = 0.5 # seconds, negative to disable live diagnostics
+        self.mutex = Lock()
+        # the timers and the futures are only touched on the event loop
+        self.timers = dict() # str(uri) -> asyncio.TimerHandle
+        self.futures = dict() # str(uri) -> asyncio.Future of the compile
+        self.versions = dict() # str(uri) -> the latest version of the document
+
+    def schedule(self, uri, version):
+        with self.mutex:
+            self.versions[uri] = version
+        self.drop_pending(uri)
+        if self.delay < 0:
+            return
+        self.timers[uri] = server.loop.call_later(self.delay, self.start, uri, version)
+
+    '''
+    forget the debounce timer and the compile which has not started yet. A
+    running compile can't be interrupted, its result is dropped instead
+    '''
+    def drop_pending(self, uri):
+        timer = self.timers.pop(uri, None)
+        if timer:
+            timer.cancel()
+        future = self.futures.pop(uri, None)
+        if future:
+            future.cancel()
+
+    def cancel(self, uri):
+        with self.mutex:
+            self.versions.pop(uri, None)
+        self.drop_pending(uri)
+
+    def is_current(self, uri, version) -> bool:
+        with self.mutex:
+            return self.versions.get(uri) == version
+
+    def start(self, uri, version):
+        self.timers.pop(uri, None)
+        # the worker pool does not need the compile thread
+        executor = None if pool else compile_executor
+        self.futures[uri] = server.loop.run_in_executor(executor, self.run, uri, version)
+
+    def run(self, uri, version):
+        doc = txt.get(uri)
+        if not doc or not self.is_current(uri, version):
+            return
+        source = doc.source
+        if pool:
+            pool.compile_document(uri, source, is_current=lambda: self.is_current(uri, version))
+            return
+        with compiler:
+            if not self.is_current(uri, version):
+                return
+            compiler.compile(uri, source, publish=False)
+            diagnostics = compiler.last_diagnostics
+        if self.is_current(uri, version):
+            call_in_server_thread(server.publish_diagnostics, uri, diagnostics)
+
+scheduler = DiagnosticsScheduler()
+
+'''
+compile a document and publish its diagnostics. The source may have been
+compiled already by the live diagnostics, which do not publish when the
+document changed meanwhile, so the diagnostics are published on a compile
+cache hit too. The caller holds the compiler lock
+'''
+def compile_and_publish(uri, source) -> bool:
+    ret = compiler.compile(uri, source, publish=False)
+    call_in_server_thread(server.publish_diagnostics, uri, compiler.last_diagnostics)
+    return ret
+
+def find_ast_by_pos(pos: Position, line_length: int):
+    #Birdee compiler marks the end of the expression, maybe in the next line
+    return compiler.find_nodes(pos.line + 1, pos.character + 1, line_length)
 
 def sourcepos2position(pos: birdeec.SourcePos, main_src_uri: str) -> (Position, str):
     if not pos: return None
     uri = from_fs_path(pos.source_path) if pos.source_idx != -1 else main_src_uri
     return (Position(pos.line - 1, pos.pos - 1), uri)
 
-def get_member_def_pos(mem: birdeec.MemberExprAST) -> birdeec.SourcePos:
-    if mem.kind == birdeec.MemberExprAST.MemberType.FIELD:
-        return mem.field.decl.pos
-    elif mem.kind == birdeec.MemberExprAST.MemberType.FUNCTION or mem.kind == birdeec.MemberExprAST.MemberType.VIRTUAL_FUNCTION:
-        return mem.func.decl.pos
-    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_DIM:
-        return mem.imported_dim.pos
-    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_FUNCTION:
-        return mem.imported_func.pos
-    return None  
-
 def get_def(uri, istr, pos: Position, line_length: int)-> (Position, str):
     ret=None
     with compiler:
@@ -216,6 +1245,176 @@ def get_def(uri, istr, pos: Position, line_length: int)-> (Position, str):
                 break	
     return ret
 
+'''
+the declaration at the cursor, as the key of the reference index. The cursor
+may be on a reference or on the declaration itself
+'''
+def find_references(uri, istr, pos: Position, line_length: int):
+    with compiler:
+        if not compiler.compile(uri, istr):
+            return None
+        for _, impl in find_ast_by_pos(pos, line_length):
+            if isinstance(impl, (birdeec.VariableSingleDefAST, birdeec.FunctionAST)):
+                target = impl.pos
+            else:
+                target, _ = get_ref_target(impl)
+            if target:
+                return get_decl_key(target, to_fs_path(uri))
+    return None
+
+SEMANTIC_TOKENS_FULL = "textDocument/semanticTokens/full"
+SEMANTIC_TOKENS_FULL_DELTA = "textDocument/semanticTokens/full/delta"
+SEMANTIC_TOKEN_TYPES = ["class", "function", "method", "property", "variable"]
+SEMANTIC_TOKEN_MODIFIERS = ["declaration"]
+TOKEN_CLASS, TOKEN_FUNCTION, TOKEN_METHOD, TOKEN_PROPERTY, TOKEN_VARIABLE = range(len(SEMANTIC_TOKEN_TYPES))
+MOD_DECLARATION = 1
+
+'''
+the semantic token of an AST node as (name, type, modifiers), or None
+'''
+def get_semantic_token(ast):
+    if isinstance(ast, birdeec.LocalVarExprAST):
+        return ast.vardef.name, TOKEN_VARIABLE, 0
+    if isinstance(ast, birdeec.ResolvedFuncExprAST):
+        return ast.funcdef.proto.name, TOKEN_FUNCTION, 0
+    if isinstance(ast, birdeec.MemberExprAST):
+        kind = ast.kind
+        if kind == birdeec.MemberExprAST.MemberType.FIELD:
+            ty = TOKEN_PROPERTY
+        elif kind == birdeec.MemberExprAST.MemberType.FUNCTION or kind == birdeec.MemberExprAST.MemberType.VIRTUAL_FUNCTION:
+            ty = TOKEN_METHOD
+        elif kind == birdeec.MemberExprAST.MemberType.IMPORTED_DIM:
+            ty = TOKEN_VARIABLE
+        elif kind == birdeec.MemberExprAST.MemberType.IMPORTED_FUNCTION:
+            ty = TOKEN_FUNCTION
+        else:
+            return None
+        return get_member_name(ast), ty, 0
+    if isinstance(ast, birdeec.VariableSingleDefAST):
+        return ast.name, TOKEN_VARIABLE, MOD_DECLARATION
+    if isinstance(ast, birdeec.FunctionAST):
+        return ast.proto.name, TOKEN_FUNCTION, MOD_DECLARATION
+    if isinstance(ast, birdeec.ClassAST):
+        return ast.name, TOKEN_CLASS, MOD_DECLARATION
+    return None
+
+'''
+the names of the classes in the declared types of a declaration. The AST has
+no position for a type name, they are found on the line of the declaration
+'''
+def get_class_references(ast) -> list:
+    types = []
+    if isinstance(ast, birdeec.VariableSingleDefAST):
+        types.append(ast.resolved_type)
+    elif isinstance(ast, birdeec.FunctionAST):
+        types += [arg.resolved_type for arg in ast.proto.args]
+        types.append(ast.proto.return_type)
+    names = []
+    for ty in types:
+        detail = ty.get_detail() if ty else None
+        if isinstance(detail, birdeec.ClassAST) and detail.name not in names:
+            names.append(detail.name)
+    return names
+
+'''
+the 0-based columns of a class name used as a type in a line, after "as" or
+"new" and maybe qualified by its module
+'''
+def locate_type_name(text, name) -> list:
+    pattern = r"\b(?:as|new)\s+(?:\w+\.)*(" + re.escape(name) + r")\b"
+    return [m.start(1) for m in re.finditer(pattern, text)]
+
+def is_word_char(ch) -> bool:
+    return ch.isalnum() or ch == "_"
+
+'''
+the 0-based column where a name starts in a line, near the 1-based column of
+its AST node. An expression is marked where it ends, the position of a
+declaration may be anywhere on its line, so the occurrence of the name
+nearest to the column is taken. Returns -1 if the name is not on the line
+'''
+def locate_name(text, name, column) -> int:
+    end = column - 1
+    if text[end - len(name):end] == name:
+        return end - len(name)
+    if text[end:end + len(name)] == name:
+        return end
+    best = -1
+    start = text.find(name)
+    while start >= 0:
+        stop = start + len(name)
+        if (start == 0 or not is_word_char(text[start - 1])) and (stop == len(text) or not is_word_char(text[stop])):
+            if best < 0 or abs(start - end) < abs(best - end):
+                best = start
+        start = text.find(name, start + 1)
+    return best
+
+'''
+the encoded semantic tokens of the compile unit, compiled from source
+'''
+def collect_semantic_tokens(source) -> list:
+    lines = source.split("\n")
+    tokens = []
+    def runfunc(ast: birdeec.StatementAST):
+        if not ast:
+            return
+        token = get_semantic_token(ast)
+        if token and token[0] and 0 < ast.pos.line <= len(lines):
+            name, ty, modifiers = token
+            column = locate_name(lines[ast.pos.line - 1], name, ast.pos.pos)
+            if column >= 0:
+                tokens.append((ast.pos.line - 1, column, len(name), ty, modifiers))
+        if 0 < ast.pos.line <= len(lines):
+            for name in get_class_references(ast):
+                for column in locate_type_name(lines[ast.pos.line - 1], name):
+                    tokens.append((ast.pos.line - 1, column, len(name), TOKEN_CLASS, 0))
+        ast.run(runfunc)
+    for a in birdeec.get_top_level():
+        runfunc(a)
+    return encode_semantic_tokens(tokens)
+
+def compute_semantic_tokens(uri, source) -> list:
+    with compiler:
+        if not compiler.compile(uri, source):
+            return None
+        return collect_semantic_tokens(source)
+
+'''
+the semantic tokens last sent for each open document, computed once per
+document version. While a document does not compile, the tokens of its last
+successful compile are kept
+'''
+class SemanticTokensCache:
+    def __init__(self):
+        self.mutex = Lock()
+        self.entries = dict() # str(uri) -> (version, str(result id), encoded tokens)
+        self.next_id = 0
+
+    def get(self, uri):
+        with self.mutex:
+            return self.entries.get(uri)
+
+    def compute(self, uri, version, source):
+        entry = self.get(uri)
+        if entry and entry[0] == version:
+            tracer.count("semantic_tokens_hit")
+            return entry
+        tracer.count("semantic_tokens_miss")
+        data = compute_semantic_tokens(uri, source)
+        if data is None:
+            return entry or (version, "", [])
+        with self.mutex:
+            self.next_id += 1
+            entry = (version, str(self.next_id), data)
+            self.entries[uri] = entry
+        return entry
+
+    def forget(self, uri):
+        with self.mutex:
+            self.entries.pop(uri, None)
+
+semantic_tokens = SemanticTokensCache()
+
 def get_signature_help(expr: birdeec.AutoCompletionExprAST):
     rty: birdeec.ResolvedType = expr.resolved_type
     if rty.base==birdeec.BasicType.FUNC and rty.index_level==0:
@@ -239,59 +1438,98 @@ completions_for_array=[
                     CompletionItem('length', kind=CompletionItemKind.Function),
                 ]
 
+'''
+member completion lists of the imported classes and modules. The AST objects
+die with the compile unit, so an entry is keyed by the qualified name of the
+class or module instead, and versioned by the metadata string of the module
+defining it: a list is reused only while that module's metadata is unchanged.
+The classes of the document being edited are not cached
+'''
+member_completion_cache = LRUCache(256)
+
+def get_cached_members(key, mod, build) -> list:
+    with compiler.meta_mutex:
+        version = compiler.module_metadata.get(mod) if mod else None
+    if version is None:
+        return build()
+    ret = member_completion_cache.get(key, version)
+    if ret is None:
+        ret = build()
+        member_completion_cache.put(key, version, ret)
+    return ret
+
+def module_of_class(clz: birdeec.ClassAST, ty: birdeec.ResolvedType):
+    if clz.pos.source_idx == -1:
+        return None
+    # "pkg.mod.Class" or a template instance "pkg.mod.Class[a.B]"
+    mod = tuple(str(ty).split("[")[0].split(".")[:-1])
+    return mod if mod else None
+
+def get_class_members(clz: birdeec.ClassAST, with_fields: bool) -> list:
+    ret=[]
+    def eachfield(idx, length, field: birdeec.FieldDef):
+        ret.append(CompletionItem(field.decl.name, kind=CompletionItemKind.Field))
+    def eachfunc(idx, length, field: birdeec.MemberFunctionDef):
+        ret.append(CompletionItem(field.decl.proto.name, kind=CompletionItemKind.Function))
+    if with_fields:
+        bdutils.foreach_field(clz, eachfield)
+    bdutils.foreach_method(clz, eachfunc)
+    return ret
+
+def get_module_members(modu: birdeec.ImportedModule) -> list:
+    ret=[]
+    for name in modu.get_classmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Class))
+    for name in modu.get_dimmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Variable))
+    for name in modu.get_funcmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Function))
+    for name in modu.get_functypemap():
+        ret.append(CompletionItem(name, CompletionItemKind.Class))
+
+    for name in modu.get_imported_classmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Class))
+    for name in modu.get_imported_dimmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Variable))
+    for name in modu.get_imported_funcmap():
+        ret.append(CompletionItem(name, CompletionItemKind.Function))
+    for name in modu.get_imported_functypemap():
+        ret.append(CompletionItem(name, CompletionItemKind.Class))
+    return ret
+
+'''
+the imported module an expression like "a.b." before the cursor refers to,
+if it names exactly one of the imports of the document
+'''
+def find_imported_module(text: str, imports: list):
+    m = re.search(r'([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)[.:]$', text)
+    if not m:
+        return None
+    owner = tuple(m.group(1).split("."))
+    candidates = set(mod for mod in imports if mod[-len(owner):] == owner)
+    return candidates.pop() if len(candidates) == 1 else None
+
 def get_completion_for_new(ty: birdeec.ResolvedType) -> CompletionList:
     if ty.index_level>0:
         return None
     detail = ty.get_detail()
     if isinstance(detail, birdeec.ClassAST):
-        ret=[]
-        def eachfunc(idx, length, field: birdeec.MemberFunctionDef):
-            nonlocal ret
-            ret.append(CompletionItem(field.decl.proto.name, kind=CompletionItemKind.Function))
-        bdutils.foreach_method(detail,eachfunc)
-        return CompletionList(False, ret)
-
-def get_completion_for_type(ty: birdeec.ResolvedType) -> CompletionList:
+        return CompletionList(False, get_cached_members(("new", str(ty)), module_of_class(detail, ty),
+            lambda: get_class_members(detail, False)))
+
+def get_completion_for_type(ty: birdeec.ResolvedType, owner_mod=None) -> CompletionList:
     if ty.index_level>0:
         return CompletionList(False, completions_for_array)
     detail = ty.get_detail()
     if isinstance(detail, birdeec.ClassAST):
-        ret=[]
-        def eachfield(idx, length, field: birdeec.FieldDef):
-            nonlocal ret
-            ret.append(CompletionItem(field.decl.name, kind=CompletionItemKind.Field))
-        bdutils.foreach_field(detail,eachfield)
-        def eachfunc(idx, length, field: birdeec.MemberFunctionDef):
-            nonlocal ret
-            ret.append(CompletionItem(field.decl.proto.name, kind=CompletionItemKind.Function))
-        bdutils.foreach_method(detail,eachfunc)
-        return CompletionList(False, ret)
+        return CompletionList(False, get_cached_members(("type", str(ty)), module_of_class(detail, ty),
+            lambda: get_class_members(detail, True)))
     if isinstance(detail, birdeec.ImportTree):
-        ret=[]
         sub = detail.get_submodules()
         if len(sub)!=0:
-            for name in sub:
-                ret.append(CompletionItem(name, CompletionItemKind.Module))
-        else:
-            modu: birdeec.ImportedModule = detail.mod
-            for name in modu.get_classmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Class))
-            for name in modu.get_dimmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Variable))
-            for name in modu.get_funcmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Function))             
-            for name in modu.get_functypemap():
-                ret.append(CompletionItem(name, CompletionItemKind.Class))
-
-            for name in modu.get_imported_classmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Class))
-            for name in modu.get_imported_dimmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Variable))
-            for name in modu.get_imported_funcmap():
-                ret.append(CompletionItem(name, CompletionItemKind.Function))             
-            for name in modu.get_imported_functypemap():
-                ret.append(CompletionItem(name, CompletionItemKind.Class))
-        return CompletionList(False, ret)            
+            return CompletionList(False, [CompletionItem(name, CompletionItemKind.Module) for name in sub])
+        return CompletionList(False, get_cached_members(("module", owner_mod), owner_mod,
+            lambda: get_module_members(detail.mod)))
 
 primitive_types=[
                     CompletionItem('byte', kind=CompletionItemKind.Class),
@@ -304,80 +1542,419 @@ primitive_types=[
                     CompletionItem('pointer', kind=CompletionItemKind.Class),
                 ]
 
-def get_module_metadata(mod)-> dict:
-    tmod = tuple(mod)
-    with compiler:
-        if tmod in compiler.module_metadata:
-            return json.loads(compiler.module_metadata[tmod])
+'''
+the metadata of a module, either parsed from the JSON or read from the binary
+.bmx. With the binary form, completions only need the name tables and the
+whole metadata is decoded only if it is asked for
+'''
+class MetadataEntry:
+    def __init__(self, meta: dict = None, binary: BinaryMetadata = None):
+        self._meta = meta
+        self.binary = binary
+        self.completions = None
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            self._meta = self.binary.to_dict()
+        return self._meta
+
+    def names(self, section) -> list:
+        if self._meta is None:
+            return self.binary.names(section)
+        return [item["name"] for item in self._meta.get(section, ()) if "name" in item]
+
+    '''
+    (name, line, column) of the items of a section, the position is 0 if the
+    metadata has none
+    '''
+    def symbols(self, section) -> list:
+        if self._meta is None:
+            return self.binary.symbols(section)
+        ret = []
+        for item in self._meta.get(section, ()):
+            if "name" in item:
+                pos = item.get("pos")
+                line, column = (pos.get("line", 0), pos.get("pos", 0)) if isinstance(pos, dict) else (0, 0)
+                ret.append((item["name"], line, column))
+        return ret
+
+    def get_completions(self) -> list:
+        if self.completions is None:
+            ret=[]
+            for name in self.names("Classes"):
+                ret.append(CompletionItem(name, CompletionItemKind.Class))
+            for name in self.names("Variables"):
+                ret.append(CompletionItem(name, CompletionItemKind.Variable))
+            for name in self.names("Functions"):
+                ret.append(CompletionItem(name, CompletionItemKind.Function))
+            for name in self.names("FunctionTemplates"):
+                ret.append(CompletionItem(name, CompletionItemKind.Function))
+            for name in self.names("FunctionTypes"):
+                ret.append(CompletionItem(name, CompletionItemKind.Function))
+            self.completions = ret
+        return self.completions
+
+# tuple[module_names] -> MetadataEntry, versioned by the metadata string in
+# compiler.module_metadata or by the path and mtime of the .bmm file
+metadata_cache = LRUCache(64)
+
+def find_metadata_file(mod):
     target=find_module_path(os.path.join(root_path, cache_path), mod, ".bmm")
-    BIRDEE_HOME=os.environ['BIRDEE_HOME']
+    BIRDEE_HOME=os.environ.get('BIRDEE_HOME')
     if not target and BIRDEE_HOME:
         target=find_module_path(os.path.join(BIRDEE_HOME, "blib"), mod, ".bmm")
+    return target
+
+def get_bmm_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return "{}|{}|{}".format(path, st.st_mtime, st.st_size)
+
+'''
+load the metadata of a module from the .bmx in the cache dir if it was made
+from the current .bmm file. Otherwise parse the JSON (raw if given, or the
+.bmm file) and write the .bmx for the next time
+'''
+def load_metadata_entry(mod, bmm_path, raw=None) -> MetadataEntry:
+    stamp = get_bmm_stamp(bmm_path) if bmm_path else None
+    bmx_path = get_cache_file(mod, ".bmx")
+    if stamp and bmx_path:
+        binary = read_binary_metadata(bmx_path, stamp)
+        if binary:
+            tracer.count("binary_metadata_hit")
+            return MetadataEntry(binary=binary)
+        tracer.count("binary_metadata_miss")
+    if raw is None:
+        with open(bmm_path) as f:
+            raw = f.read()
+    meta = json.loads(raw)
+    if stamp and bmx_path:
+        try:
+            write_file_atomic(bmx_path, dump_binary_metadata(meta, stamp))
+        except (OSError, struct.error):
+            pass
+    return MetadataEntry(meta)
+
+def get_module_metadata_entry(mod) -> MetadataEntry:
+    tmod = tuple(mod)
+    with compiler.meta_mutex:
+        if compiler.has_module(tmod):
+            raw = compiler.module_metadata[tmod]
+            # the metadata string is replaced on every update of the module, and
+            # comparing it with the cached one short-circuits on identity
+            version = raw
+            entry = metadata_cache.get(tmod, version)
+            if entry:
+                return entry
+            # the .bmm in the cache dir holds the same metadata once it is persisted
+            node = compiler.graph.nodes.get(tmod)
+            persisted = node is not None and compiler.persisted.get(tmod) == node.hash
+            bmm_path = get_cache_file(tmod, ".bmm") if persisted else None
+            entry = load_metadata_entry(tmod, bmm_path, raw)
+            metadata_cache.put(tmod, version, entry)
+            return entry
+    target=find_metadata_file(mod)
     if target:
-        with open(target) as f:
-            return json.load(f)
+        version = (target, get_mtime(target))
+        with compiler.meta_mutex:
+            entry = metadata_cache.get(tmod, version)
+        if not entry:
+            entry = load_metadata_entry(tmod, target)
+            with compiler.meta_mutex:
+                metadata_cache.put(tmod, version, entry)
+        return entry
 
 def get_completion_for_name_import(modname: str)-> CompletionList:
     if modname.endswith(':'):
         modname=modname[:-1]
-    meta=get_module_metadata(modname.split("."))
-    if meta:
-        ret=[]
-        for clz in meta["Classes"]:
-            ret.append(CompletionItem(clz["name"], CompletionItemKind.Class))
-        for var in meta["Variables"]:
-            ret.append(CompletionItem(var["name"], CompletionItemKind.Variable))
-        for var in meta["Functions"]:
-            ret.append(CompletionItem(var["name"], CompletionItemKind.Function))        
-        for var in meta["FunctionTemplates"]:
-            if "name" in var:
-                ret.append(CompletionItem(var["name"], CompletionItemKind.Function))
-        for var in meta["FunctionTypes"]:
-            ret.append(CompletionItem(var["name"], CompletionItemKind.Function))
-        return CompletionList(False, ret) 
-
-def array_starts_with(large, small):
-    if len(large)<len(small):
-        return False
-    for i, itm in enumerate(small):
-        if large[i]!=itm:
-            return False
-    return True
+    entry=get_module_metadata_entry(modname.split("."))
+    if entry:
+        return CompletionList(False, entry.get_completions())
+
+CompletionItemKindFolder=19
+
+'''
+names of all known modules: the compiled ones in memory, the .bdm sources
+under sourceRoot, the .bmm files in the cache dir and in $BIRDEE_HOME/blib.
+The directories are walked once when the configuration arrives, then the
+index is kept up to date by workspace/didChangeWatchedFiles
+'''
+class ModuleNameIndex:
+    def __init__(self):
+        self.mutex = Lock()
+        self.trie = ModuleTrie()
+        self.roots = [] # list of (origin, root dir, extension)
+        self.generation = 0 # changed on every update of the trie
+
+    def get_roots(self) -> list:
+        ret = []
+        if root_path is not None and source_root_path is not None:
+            ret.append(("source", os.path.join(root_path, source_root_path), ".bdm"))
+        cache_root = get_cache_root()
+        if cache_root:
+            ret.append(("cache", cache_root, ".bmm"))
+        BIRDEE_HOME=os.environ.get('BIRDEE_HOME')
+        if BIRDEE_HOME:
+            ret.append(("blib", os.path.join(BIRDEE_HOME, "blib"), ".bmm"))
+        return ret
+
+    def build(self):
+        roots = self.get_roots()
+        trie = ModuleTrie()
+        for origin, root, ext in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+                rel = os.path.relpath(dirpath, root)
+                prefix = () if rel == "." else tuple(rel.split(os.sep))
+                for fname in filenames:
+                    if fname.endswith(ext):
+                        trie.add(prefix + (fname[:-len(ext)],), origin)
+        with compiler.meta_mutex:
+            mods = list(compiler.module_metadata)
+        for mod in mods:
+            trie.add(mod, "memory")
+        with self.mutex:
+            self.roots = roots
+            self.trie = trie
+            self.generation += 1
+
+    def module_of_file(self, path):
+        path = os.path.abspath(path)
+        with self.mutex:
+            roots = self.roots
+        for origin, root, ext in roots:
+            if not path.endswith(ext):
+                continue
+            rel = os.path.relpath(path, os.path.abspath(root))
+            parts = rel[:-len(ext)].split(os.sep)
+            if parts[0] == ".." or any(part.startswith(".") for part in parts):
+                continue
+            return origin, tuple(parts)
+        return None, None
+
+    def add(self, mod, origin):
+        with self.mutex:
+            self.trie.add(mod, origin)
+            self.generation += 1
+
+    def remove(self, mod, origin):
+        with self.mutex:
+            self.trie.remove(mod, origin)
+            self.generation += 1
+
+    def children(self, prefix) -> list:
+        with self.mutex:
+            return self.trie.children(prefix)
+
+    def modules(self, origin) -> list:
+        with self.mutex:
+            return self.trie.modules(origin)
+
+    def get_generation(self) -> int:
+        with self.mutex:
+            return self.generation
+
+module_index = ModuleNameIndex()
+
+def build_indexes():
+    module_index.build()
+    # prebuild the symbols of the modules with metadata in the cache dir
+    symbol_index.refresh()
+
+'''
+workspace/symbol over the metadata of the modules in the workspace. The
+modules are indexed on the first query which finds them, and re-indexed on
+the next query after their metadata changes, from the name tables of their
+.bmx when there is one
+'''
+class WorkspaceSymbols:
+    SECTIONS = (("Classes", SymbolKind.Class), ("Functions", SymbolKind.Function),
+        ("FunctionTemplates", SymbolKind.Function), ("Variables", SymbolKind.Variable),
+        ("FunctionTypes", SymbolKind.Interface))
+
+    def __init__(self):
+        # guards seen and dirty, and is taken by store_module with meta_mutex held
+        self.mutex = Lock()
+        # guards the index and versions, and is held while reading the metadata
+        self.index_mutex = Lock()
+        self.index = SymbolIndex()
+        self.seen = set() # the modules found in the workspace so far
+        self.dirty = set() # the modules to index on the next query
+        self.versions = dict() # tuple[module_names] -> source hash of the indexed metadata
+        self.generation = None # of module_index when the modules were last looked for
+
+    def mark(self, mod):
+        with self.mutex:
+            self.dirty.add(mod)
+
+    def remove(self, mod):
+        with self.mutex:
+            self.seen.discard(mod)
+            self.dirty.discard(mod)
+        with self.index_mutex:
+            self.versions.pop(mod, None)
+            self.index.remove(mod)
+
+    def index_module(self, mod):
+        with compiler.meta_mutex:
+            node = compiler.graph.nodes.get(mod)
+            version = node.hash if node else None
+            path = node.path if node else None
+        if version is not None and self.versions.get(mod) == version:
+            return
+        try:
+            entry = get_module_metadata_entry(mod)
+        except (OSError, ValueError):
+            return
+        if not entry:
+            return
+        path = path or find_source_path(mod)
+        uri = from_fs_path(os.path.normpath(path)) if path else None
+        container = ".".join(mod)
+        symbols = []
+        for section, kind in self.SECTIONS:
+            for name, line, column in entry.symbols(section):
+                symbols.append((name, (kind, container, uri, max(line - 1, 0), max(column - 1, 0))))
+        self.index.update(mod, symbols)
+        self.versions[mod] = version
+
+    def refresh(self):
+        generation = module_index.get_generation()
+        if generation != self.generation:
+            found = set(module_index.modules("source")) | set(module_index.modules("memory"))
+            with self.mutex:
+                self.dirty |= found - self.seen
+                self.seen |= found
+                self.generation = generation
+        with self.mutex:
+            dirty = self.dirty
+            self.dirty = set()
+        with self.index_mutex:
+            for mod in dirty:
+                self.index_module(mod)
+
+    def search(self, query) -> list:
+        self.refresh()
+        with self.index_mutex:
+            ret = []
+            for name, (kind, container, uri, line, column) in self.index.search(query):
+                if uri:
+                    pos = Position(line, column)
+                    ret.append(SymbolInformation(name, kind, Location(uri, Range(pos, pos)), container))
+            return ret
+
+symbol_index = WorkspaceSymbols()
+
+'''
+textDocument/references over the reverse index of the references. The
+references of a module are recorded when it is compiled, or read from its
+.bref in the cache dir if it was compiled in an earlier session
+'''
+class WorkspaceReferences:
+    def __init__(self):
+        # guards the index and looked_up, and is taken by store_module with meta_mutex held
+        self.mutex = Lock()
+        self.index = ReferenceIndex()
+        self.looked_up = set() # the modules whose references were recorded or looked for
+        self.generation = None # of module_index when the cache dir was last looked for
+
+    def update(self, mod, path, refs):
+        with self.mutex:
+            self.index.update(mod, os.path.normpath(os.path.abspath(path)), refs)
+            self.looked_up.add(mod)
+
+    def remove(self, mod):
+        with self.mutex:
+            self.index.remove(mod)
+
+    def get(self, mod) -> list:
+        with self.mutex:
+            return self.index.get(mod)
+
+    def load_cached(self, mod):
+        bref_path = get_cache_file(mod, ".bref")
+        if not bref_path or not os.path.exists(bref_path):
+            return
+        dep_info = compiler.read_cached_deps(mod)
+        if dep_info is None or not dep_info["path"]:
+            return
+        try:
+            with open(bref_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("hash") != dep_info["hash"]:
+            return
+        with self.mutex:
+            # the module may have been compiled in the meantime
+            if mod not in self.index:
+                self.index.update(mod, os.path.normpath(os.path.abspath(dep_info["path"])), cached["refs"])
+
+    def refresh(self):
+        generation = module_index.get_generation()
+        with self.mutex:
+            if generation == self.generation:
+                return
+            self.generation = generation
+            pending = [mod for mod in module_index.modules("cache") if mod not in self.looked_up]
+            self.looked_up.update(pending)
+        for mod in pending:
+            self.load_cached(mod)
+
+    '''
+    the uses of a declaration as a list of (source path, line, column, length)
+    '''
+    def find(self, decl) -> list:
+        self.refresh()
+        with self.mutex:
+            return self.index.find(decl)
+
+reference_index = WorkspaceReferences()
 
 def get_completion_for_import(importcode: str)-> CompletionList:
     if importcode.endswith('.'):
         importcode=importcode[:-1]
-    mod=importcode.split(".")
-    CompletionItemKindFolder=19
-    ret=dict()
+    mod=importcode.split(".") if importcode else []
+    ret=[]
+    for name, is_module, _ in module_index.children(mod):
+        ret.append(CompletionItem(name, CompletionItemKind.Module if is_module else CompletionItemKindFolder))
+    return CompletionList(False, ret)
+
+def complete_type_names(uri) -> CompletionList:
     with compiler:
-        for cmod in compiler.module_metadata:
-            if array_starts_with(cmod, mod):
-                if len(cmod)>=len(mod):
-                    name=cmod[len(mod)]
-                    if name not in ret:
-                        ret[name]=CompletionItem(name, 
-                            CompletionItemKind.Module if len(cmod)==len(mod)+1 else CompletionItemKindFolder)
-    def find_next_in_directory(root: str, ext: str):
-        path=os.path.join(root, *mod)
-        _, dirnames, filenames = next(os.walk(path), (None, [], []))
-        for name in dirnames:
-            if not name.startswith(".") and name not in ret:
-                ret[name]=CompletionItem(name, CompletionItemKindFolder)
-        for fname in filenames:
-            if fname.endswith(ext):
-                name=fname[:-len(ext)]
-                if name not in ret:
-                    ret[name]=CompletionItem(name, CompletionItemKind.Module)
-    find_next_in_directory(os.path.join(source_root_path, cache_path), ".bmm")
-    find_next_in_directory(source_root_path, ".bdm")
-    BIRDEE_HOME=os.environ['BIRDEE_HOME']
-    if BIRDEE_HOME:
-        find_next_in_directory(os.path.join(BIRDEE_HOME, "blib"), ".bmm")
-    return CompletionList(False, list(ret.values()))
+        compiler.switch_to_last_successful(uri)
+        class_names = list(birdeec.get_classes(True).keys()) + list(birdeec.get_classes(False).keys())
+        functype_names = list(birdeec.get_functypes(True).keys()) + list(birdeec.get_functypes(False).keys())
+    cls_completion = [CompletionItem(name) for name in class_names]
+    func_completion = [CompletionItem(name, kind=CompletionItemKind.Function) for name in functype_names]
+    return CompletionList(False, primitive_types + cls_completion + func_completion)
+
+def complete_member(uri, src, owner_mod) -> CompletionList:
+    with compiler:
+        compiler.compile_for_completion(uri, src)
+        expr=birdeec.get_auto_completion_ast()
+        if expr:
+            if expr.kind == birdeec.AutoCompletionExprAST.CompletionKind.NEW:
+                return get_completion_for_new(expr.resolved_type)
+            else:
+                return get_completion_for_type(expr.resolved_type, owner_mod)
+    return None
+
+def find_signature(uri, src) -> SignatureHelp:
+    with compiler:
+        compiler.compile_for_completion(uri, src)
+        expr=birdeec.get_auto_completion_ast()
+        if expr:
+            if expr.kind == birdeec.AutoCompletionExprAST.CompletionKind.PARAMETER:
+                return get_signature_help(expr)
+    return None
 
 @server.feature(COMPLETION, trigger_characters=[' ', '.', ":"])
-def completions(params: CompletionParams):
+@tracer.traced("completions")
+async def completions(params: CompletionParams):
     #bybass a bug (?) of pygls 
     if not hasattr(params.context, 'triggerKind'):
         return None
@@ -390,13 +1967,7 @@ def completions(params: CompletionParams):
             if stripped.startswith("import "):
                 return get_completion_for_import("")
             if istr[pos-3:pos]=="as " or istr[pos-4:pos]=="new ":
-                    with compiler:
-                        compiler.switch_to_last_successful(params.textDocument.uri)
-                    class_names = list(birdeec.get_classes(True).keys()) + list(birdeec.get_classes(False).keys())
-                    functype_names = list(birdeec.get_functypes(True).keys()) + list(birdeec.get_functypes(False).keys())
-                    cls_completion = [CompletionItem(name) for name in class_names]
-                    func_completion = [CompletionItem(name, kind=CompletionItemKind.Function) for name in functype_names]
-                    return CompletionList(False, primitive_types + cls_completion + func_completion)
+                    return await run_compiler(complete_type_names, params.textDocument.uri)
         if params.context.triggerCharacter=='.' or params.context.triggerCharacter==':':
             t: Document = txt[params.textDocument.uri]
             pos = params.position.character
@@ -408,42 +1979,72 @@ def completions(params: CompletionParams):
                 if params.context.triggerCharacter=='.':
                     return get_completion_for_import(importcode)
                 else:
-                    return get_completion_for_name_import(importcode)
+                    return await run_io(get_completion_for_name_import, importcode)
+            owner_mod = find_imported_module(istr[line][:pos], parse_imports(t.source))
             istr[line]= istr[line][:pos] + ":" + istr[line][pos:]
-            src="\n".join(istr)
-            expr=None
-            with compiler:
-                compiler.compile(params.textDocument.uri, src)
-                expr=birdeec.get_auto_completion_ast()
-            if expr:
-                if expr.kind == birdeec.AutoCompletionExprAST.CompletionKind.NEW:
-                    return get_completion_for_new(expr.resolved_type)
-                else:
-                    return get_completion_for_type(expr.resolved_type)
+            src="".join(istr)
+            return await run_compiler(complete_member, params.textDocument.uri, src, owner_mod)
     return None
 
+'''
+the prototype resolved for the call being edited. While the cursor stays in
+the same call and the text before its paren is unchanged, the active
+parameter is found by find_call_site instead of compiling the document
+'''
+class CallSite:
+    def __init__(self, line, paren, prefix, signatures):
+        self.line = line
+        self.paren = paren
+        self.prefix = prefix # the text of the line before the paren
+        self.signatures = signatures
+
+    def matches(self, line, paren, text) -> bool:
+        return self.line == line and self.paren == paren and text[:paren] == self.prefix
+
+call_sites = dict() # str(uri) -> CallSite
+
+'''
+the cached call site is kept only for edits within its own line, since an
+edit elsewhere may change the callee's declaration
+'''
+def invalidate_call_site(uri, changes):
+    site = call_sites.get(uri)
+    if not site:
+        return
+    for ch in changes:
+        if not ch.range or ch.range.start.line != site.line or ch.range.end.line != site.line or "\n" in ch.text:
+            del call_sites[uri]
+            return
+
 @server.feature(SIGNATURE_HELP, trigger_characters=['(', ','], retrigger_characters = [','])
-def signature_help(params: TextDocumentPositionParams):
+@tracer.traced("signature_help")
+async def signature_help(params: TextDocumentPositionParams):
     t: Document = txt[params.textDocument.uri]
     pos = params.position.character
     line = params.position.line
     istr = t.lines
-    istr[line]= istr[line][:pos] + ":" + istr[line][pos:]
-    src="\n".join(istr)
-    expr=None
-    with compiler:
-        compiler.compile(params.textDocument.uri, src)
-        expr=birdeec.get_auto_completion_ast()
-    if expr:
-        if expr.kind == birdeec.AutoCompletionExprAST.CompletionKind.PARAMETER:
-            return get_signature_help(expr)
-    return None
+    text = istr[line]
+    site = find_call_site(text, pos)
+    cached = call_sites.get(params.textDocument.uri)
+    if site and cached and cached.matches(line, site[0], text):
+        tracer.count("signature_cache_hit")
+        return SignatureHelp(cached.signatures, active_parameter=site[1])
+    tracer.count("signature_cache_miss")
+    call_sites.pop(params.textDocument.uri, None)
+    istr[line]= text[:pos] + ":" + text[pos:]
+    src="".join(istr)
+    ret = await run_compiler(find_signature, params.textDocument.uri, src)
+    # cache only if the lexical scan agrees with the compiler
+    if ret and site and ret.activeParameter == site[1]:
+        call_sites[params.textDocument.uri] = CallSite(line, site[0], text[:site[0]], ret.signatures)
+    return ret
 
 @server.feature(DEFINITION)
-def definitions(params: TextDocumentPositionParams):
+@tracer.traced("definitions")
+async def definitions(params: TextDocumentPositionParams):
     uri=params.textDocument.uri
     line_length = len(txt[uri].lines[params.position.line])
-    r, outuri=get_def(uri, txt[uri].source, params.position, line_length)
+    r, outuri=await run_compiler(get_def, uri, txt[uri].source, params.position, line_length)
     if r:
         return Location(outuri, Range(
             r, Position(r.line, r.character+1)
@@ -451,37 +2052,180 @@ def definitions(params: TextDocumentPositionParams):
     else:
         return None
 
+@server.feature(REFERENCES)
+@tracer.traced("references")
+async def references(params: ReferenceParams):
+    uri=params.textDocument.uri
+    line_length = len(txt[uri].lines[params.position.line])
+    decl = await run_compiler(find_references, uri, txt[uri].source, params.position, line_length)
+    if not decl:
+        return None
+    uses = await run_io(reference_index.find, decl)
+    ret = []
+    if params.context.includeDeclaration:
+        path, line, column = decl
+        pos = Position(line - 1, column - 1)
+        ret.append(Location(from_fs_path(path), Range(pos, Position(pos.line, pos.character + 1))))
+    for path, line, column, length in uses:
+        pos = Position(line - 1, column - 1)
+        ret.append(Location(from_fs_path(path), Range(pos, Position(pos.line, pos.character + length))))
+    return ret
+
+@server.feature(SEMANTIC_TOKENS_FULL)
+@tracer.traced("semantic_tokens_full")
+async def semantic_tokens_full(params):
+    uri=params.textDocument.uri
+    doc = txt[uri]
+    _, result_id, data = await run_compiler(semantic_tokens.compute, uri, doc.version, doc.source)
+    return {"resultId": result_id, "data": data}
+
+'''
+only the change since the tokens the client has is sent. If the client's
+tokens are not the last ones sent, all the tokens are sent instead
+'''
+@server.feature(SEMANTIC_TOKENS_FULL_DELTA)
+@tracer.traced("semantic_tokens_delta")
+async def semantic_tokens_delta(params):
+    uri=params.textDocument.uri
+    doc = txt[uri]
+    previous = semantic_tokens.get(uri)
+    _, result_id, data = await run_compiler(semantic_tokens.compute, uri, doc.version, doc.source)
+    if not previous or previous[1] != params.previousResultId:
+        return {"resultId": result_id, "data": data}
+    if previous[1] == result_id:
+        return {"resultId": result_id, "edits": []}
+    start, delete_count, inserted = diff_semantic_tokens(previous[2], data)
+    return {"resultId": result_id, "edits": [{"start": start, "deleteCount": delete_count, "data": inserted}]}
+
+@server.feature(WORKSPACE_SYMBOL)
+@tracer.traced("workspace_symbol")
+async def workspace_symbols(params: WorkspaceSymbolParams):
+    return await run_io(symbol_index.search, params.query)
+
+@server.feature(INITIALIZED)
+def oninitialized(params):
+    watchers = [{"globPattern": "**/*.bdm"}, {"globPattern": "**/*.bmm"}]
+    server.register_capability(RegistrationParams([Registration("birdee-module-files",
+        WORKSPACE_DID_CHANGE_WATCHED_FILES, {"watchers": watchers})]), None)
+
+@server.feature(WORKSPACE_DID_CHANGE_WATCHED_FILES)
+def didchangewatchedfiles(params: DidChangeWatchedFiles):
+    for change in params.changes:
+        origin, mod = module_index.module_of_file(to_fs_path(change.uri))
+        if not mod:
+            continue
+        if change.type == FileChangeType.Deleted:
+            module_index.remove(mod, origin)
+            if origin == "source":
+                symbol_index.remove(mod)
+                reference_index.remove(mod)
+        else:
+            module_index.add(mod, origin)
+        if origin == "source":
+            with compiler.meta_mutex:
+                if mod in compiler.module_metadata and compiler.graph.is_stale(mod):
+                    compiler.invalidate(mod)
+
 @server.feature(INITIALIZE)
 def oninitialize(params: InitializeParams):
     global root_path
     root_path = params.rootPath
 
+'''
+pygls does not know semantic tokens, so their provider is added to the
+capabilities computed by its initialize handler. It is only advertised to
+the clients which can request semantic tokens
+'''
+def initialize_with_semantic_tokens(base):
+    @functools.wraps(base)
+    def wrapper(params):
+        ret = base(params)
+        text_document = getattr(params.capabilities, "textDocument", None)
+        if getattr(text_document, "semanticTokens", None):
+            ret.capabilities.semanticTokensProvider = {"full": {"delta": True},
+                "legend": {"tokenTypes": SEMANTIC_TOKEN_TYPES, "tokenModifiers": SEMANTIC_TOKEN_MODIFIERS}}
+        return ret
+    return wrapper
+
+server.lsp.fm.add_builtin_feature(INITIALIZE, initialize_with_semantic_tokens(server.lsp.fm.builtin_features[INITIALIZE]))
+
 @server.feature(TEXT_DOCUMENT_DID_CHANGE)
 def didchange(params: DidChangeTextDocumentParams):
+    doc = txt[params.textDocument.uri]
+    invalidate_call_site(params.textDocument.uri, params.contentChanges)
     for ch in params.contentChanges:
-        txt[params.textDocument.uri].apply_change(ch)
+        doc.apply_change(ch)
+    doc.version = params.textDocument.version
+    scheduler.schedule(params.textDocument.uri, doc.version)
 
 @server.feature(TEXT_DOCUMENT_DID_OPEN)
-def didopen(params: DidOpenTextDocumentParams):
+@tracer.traced("didopen")
+async def didopen(params: DidOpenTextDocumentParams):
     uri=params.textDocument.uri
-    txt[uri]=Document(uri)
-    with compiler:
-        compiler.compile(uri, params.textDocument.text)
+    txt[uri]=Document(uri, source=params.textDocument.text, version=params.textDocument.version)
+    call_sites.pop(uri, None)
+    scheduler.cancel(uri)
+    if pool:
+        pool.submit_document(uri, params.textDocument.text)
+        return
+    def compileit():
+        with compiler:
+            compile_and_publish(uri, params.textDocument.text)
+    await run_compiler(compileit)
     
+@server.feature(TEXT_DOCUMENT_DID_CLOSE)
+def didclose(params: DidCloseTextDocumentParams):
+    uri=params.textDocument.uri
+    txt.pop(uri, None)
+    call_sites.pop(uri, None)
+    scheduler.cancel(uri)
+    semantic_tokens.forget(uri)
+    compiler.forget(uri)
+
 @server.feature(TEXT_DOCUMENT_DID_SAVE)
-def didsave(params: DidSaveTextDocumentParams):
-    with compiler:
-        uri=params.textDocument.uri
-        compiler.compile(uri, txt[uri].source)
+@tracer.traced("didsave")
+async def didsave(params: DidSaveTextDocumentParams):
+    uri=params.textDocument.uri
+    call_sites.pop(uri, None)
+    scheduler.cancel(uri)
+    source = txt[uri].source
+    if pool:
+        pool.submit_document(uri, source, True)
+        return
+    def compileit():
+        with compiler:
+            if compile_and_publish(uri, source):
+                compiler.recompile_invalidated()
+    await run_compiler(compileit)
 
 @server.feature(WORKSPACE_DID_CHANGE_CONFIGURATION)
 def onconfigchange(params: DidChangeConfigurationParams):
-    global source_root_path, cache_path
-    source_root_path = params.settings.birdeeLanguageServer.sourceRoot
-    cache_path = params.settings.birdeeLanguageServer.lspCache
+    global source_root_path, cache_path, compiler_path
+    settings = params.settings.birdeeLanguageServer
+    source_root_path = settings.sourceRoot
+    cache_path = settings.lspCache
+    compiler_path = getattr(settings, "compilerPath", None)
+    start_pool(getattr(settings, "compileWorkers", 0))
+    if module_index.get_roots() != module_index.roots:
+        Thread(target=build_indexes, daemon=True).start()
+    if getattr(settings, "indexWorkspace", False):
+        indexer.start()
+    cache_root = get_cache_root()
+    if getattr(settings, "traceLog", False) and cache_root:
+        tracer.enable_log(os.path.join(cache_root, "birdeelsp.log"))
+    delay = getattr(settings, "diagnosticsDelay", 500)
+    scheduler.delay = delay / 1000.0 if delay >= 0 else -1
+    budget = getattr(settings, "metadataMemoryBudget", 256)
+    compiler.set_metadata_budget(int(budget * 1024 * 1024) if budget > 0 else 0)
+
+@server.feature("birdee/stats")
+def onstats(params):
+    return tracer.stats()
 
 @server.feature(SHUTDOWN)
 def onexit(params):
+    if pool:
+        pool.close()
     compiler.on_exit()
 
 server.start_io()
\ No newline at end of file
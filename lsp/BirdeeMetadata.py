@@ -0,0 +1,156 @@
+'''
+A compact binary form of the Birdee module metadata (.bmx), kept next to the
+JSON .bmm. Every list of named items in the metadata (Classes, Functions,
+Variables...) is a section with a name table and the JSON of each item, so the
+names and positions can be read from a memory map without decoding any item:
+
+    "BMX2"
+    u16 length, stamp           identifies the .bmm the file was made from
+    u16 number of sections
+    for each section:
+        u8 length, key
+        u32 item count, u32 name table offset, u32 name table length,
+        u32 items offset, u32 items length
+    u32 offset, u32 length      JSON of the other keys of the metadata
+    name tables: for each item: u32 length, name, u32 line, u32 column (0 if
+        the item has no "pos"), u32 offset in the items, u32 length of the
+        item's JSON
+    items: the compact JSON of each item
+
+All the numbers are little-endian and the offsets are from the start of the
+file
+'''
+import json
+import mmap
+import struct
+
+MAGIC = b"BMX2"
+
+def dump_binary_metadata(meta: dict, stamp: str) -> bytes:
+    sections = []
+    rest = dict()
+    for key, value in meta.items():
+        if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+            sections.append((key, value))
+        else:
+            rest[key] = value
+    stamp_bytes = stamp.encode("utf-8")
+    blocks = []
+    for key, items in sections:
+        names = bytearray()
+        bodies = bytearray()
+        for item in items:
+            body = json.dumps(item, separators=(",", ":")).encode("utf-8")
+            name = str(item.get("name", "")).encode("utf-8")
+            pos = item.get("pos")
+            line, column = (pos.get("line", 0), pos.get("pos", 0)) if isinstance(pos, dict) else (0, 0)
+            names += struct.pack("<I", len(name)) + name
+            names += struct.pack("<IIII", line, column, len(bodies), len(body))
+            bodies += body
+        blocks.append((key.encode("utf-8"), len(items), bytes(names), bytes(bodies)))
+    rest_bytes = json.dumps(rest, separators=(",", ":")).encode("utf-8")
+
+    offset = len(MAGIC) + 2 + len(stamp_bytes) + 2 + sum(1 + len(key) + 20 for key, _, _, _ in blocks) + 8
+    header = bytearray(MAGIC)
+    header += struct.pack("<H", len(stamp_bytes)) + stamp_bytes + struct.pack("<H", len(blocks))
+    data = bytearray()
+    for key, count, names, bodies in blocks:
+        header += struct.pack("<B", len(key)) + key
+        header += struct.pack("<IIIII", count, offset, len(names), offset + len(names), len(bodies))
+        offset += len(names) + len(bodies)
+        data += names
+        data += bodies
+    header += struct.pack("<II", offset, len(rest_bytes))
+    return bytes(header + data + rest_bytes)
+
+'''
+a .bmx file. Only the header is read when it is opened, the name table of a
+section is decoded on its first use and an item when it is asked for
+'''
+class BinaryMetadata:
+    def __init__(self, buf):
+        self.buf = buf
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a binary metadata file")
+        pos = len(MAGIC)
+        (length,) = struct.unpack_from("<H", buf, pos)
+        pos += 2
+        self.stamp = bytes(buf[pos:pos + length]).decode("utf-8")
+        pos += length
+        (count,) = struct.unpack_from("<H", buf, pos)
+        pos += 2
+        self.sections = dict() # str(key) -> (count, names offset, names length, items offset, items length)
+        for _ in range(count):
+            (length,) = struct.unpack_from("<B", buf, pos)
+            pos += 1
+            key = bytes(buf[pos:pos + length]).decode("utf-8")
+            pos += length
+            self.sections[key] = struct.unpack_from("<IIIII", buf, pos)
+            pos += 20
+        self.rest = struct.unpack_from("<II", buf, pos)
+        self.tables = dict() # str(key) -> list of (name, line, column, offset, length)
+
+    @staticmethod
+    def open(path):
+        with open(path, "rb") as f:
+            return BinaryMetadata(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def table(self, key) -> list:
+        table = self.tables.get(key)
+        if table is None:
+            table = []
+            if key in self.sections:
+                count, pos, _, items, _ = self.sections[key]
+                buf = self.buf
+                for _ in range(count):
+                    (length,) = struct.unpack_from("<I", buf, pos)
+                    pos += 4
+                    name = bytes(buf[pos:pos + length]).decode("utf-8")
+                    pos += length
+                    line, column, offset, size = struct.unpack_from("<IIII", buf, pos)
+                    pos += 16
+                    table.append((name, line, column, items + offset, size))
+            self.tables[key] = table
+        return table
+
+    '''
+    the names of the items of a section, without the unnamed ones
+    '''
+    def names(self, key) -> list:
+        return [entry[0] for entry in self.table(key) if entry[0]]
+
+    '''
+    (name, line, column) of the named items of a section
+    '''
+    def symbols(self, key) -> list:
+        return [entry[:3] for entry in self.table(key) if entry[0]]
+
+    def item(self, key, index) -> dict:
+        _, _, _, offset, size = self.table(key)[index]
+        return json.loads(bytes(self.buf[offset:offset + size]).decode("utf-8"))
+
+    def find(self, key, name) -> dict:
+        for index, entry in enumerate(self.table(key)):
+            if entry[0] == name:
+                return self.item(key, index)
+        return None
+
+    def to_dict(self) -> dict:
+        offset, size = self.rest
+        ret = json.loads(bytes(self.buf[offset:offset + size]).decode("utf-8"))
+        for key in self.sections:
+            ret[key] = [self.item(key, index) for index in range(len(self.table(key)))]
+        return ret
+
+'''
+open a .bmx file if it was made from the .bmm identified by the stamp.
+Returns None if the file is missing, stale or broken
+'''
+def read_binary_metadata(path, stamp) -> BinaryMetadata:
+    try:
+        ret = BinaryMetadata.open(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if ret.stamp != stamp:
+        return None
+    return ret
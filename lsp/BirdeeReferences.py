@@ -0,0 +1,78 @@
+'''
+Resolution of the Birdee AST nodes referring to a declaration, shared by the
+language server and its compile workers. After a module is compiled, its
+references are collected from the AST of the compile unit in the form kept by
+ReferenceIndex: a list of [declaration path, line, column, uses], each use
+being [line, column, length]. The lines and columns are 1-based like SourcePos
+'''
+import os
+import birdeec
+
+def get_member_def_pos(mem: birdeec.MemberExprAST) -> birdeec.SourcePos:
+    if mem.kind == birdeec.MemberExprAST.MemberType.FIELD:
+        return mem.field.decl.pos
+    elif mem.kind == birdeec.MemberExprAST.MemberType.FUNCTION or mem.kind == birdeec.MemberExprAST.MemberType.VIRTUAL_FUNCTION:
+        return mem.func.decl.pos
+    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_DIM:
+        return mem.imported_dim.pos
+    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_FUNCTION:
+        return mem.imported_func.pos
+    return None
+
+def get_member_name(mem: birdeec.MemberExprAST) -> str:
+    if mem.kind == birdeec.MemberExprAST.MemberType.FIELD:
+        return mem.field.decl.name
+    elif mem.kind == birdeec.MemberExprAST.MemberType.FUNCTION or mem.kind == birdeec.MemberExprAST.MemberType.VIRTUAL_FUNCTION:
+        return mem.func.decl.proto.name
+    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_DIM:
+        return mem.imported_dim.name
+    elif mem.kind == birdeec.MemberExprAST.MemberType.IMPORTED_FUNCTION:
+        return mem.imported_func.proto.name
+    return ""
+
+'''
+the declaration an expression refers to, as (SourcePos, name), or
+(None, None) if the node is not a reference
+'''
+def get_ref_target(ast):
+    if isinstance(ast, birdeec.LocalVarExprAST):
+        return ast.vardef.pos, ast.vardef.name
+    if isinstance(ast, birdeec.ResolvedFuncExprAST):
+        return ast.funcdef.pos, ast.funcdef.proto.name
+    if isinstance(ast, birdeec.MemberExprAST):
+        pos = get_member_def_pos(ast)
+        return (pos, get_member_name(ast)) if pos else (None, None)
+    return None, None
+
+'''
+the declaration as (source path, line, column). The declarations of the
+compile unit itself are in the source file being compiled
+'''
+def get_decl_key(pos: birdeec.SourcePos, fspath):
+    path = pos.source_path if pos.source_idx != -1 else fspath
+    return (os.path.normpath(os.path.abspath(path)), pos.line, pos.pos)
+
+'''
+the references of the compile unit, compiled from the source file fspath.
+Birdee marks an expression by the position where it ends, so a use starts
+at the length of the name before it
+'''
+def collect_references(fspath) -> list:
+    uses = dict() # (path, line, column) -> set of (line, column, length)
+    paths = dict() # source path of the declarations -> normalized path, None for fspath
+    def runfunc(ast: birdeec.StatementAST):
+        if not ast:
+            return
+        pos, name = get_ref_target(ast)
+        if pos:
+            source_path = pos.source_path if pos.source_idx != -1 else None
+            path = paths.get(source_path)
+            if path is None:
+                path = paths[source_path] = os.path.normpath(os.path.abspath(source_path or fspath))
+            length = len(name or "")
+            # a node may be reached twice, as a child of two expressions
+            uses.setdefault((path, pos.line, pos.pos), set()).add((ast.pos.line, max(ast.pos.pos - length, 1), length))
+        ast.run(runfunc)
+    for a in birdeec.get_top_level():
+        runfunc(a)
+    return [[path, line, column, [list(use) for use in sorted(sites)]] for (path, line, column), sites in uses.items()]
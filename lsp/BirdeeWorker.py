@@ -0,0 +1,66 @@
+'''
+A compile worker of the Birdee language server. Each worker is a separate
+birdeec process owning its own compile unit. It reads one JSON request per
+line from stdin and writes one JSON response per line to stdout, prefixed by
+a marker so that anything else printed by the compiler is ignored.
+
+request:  {"id", "path", "source", "metadata": {"a.b": json}, "known": ["a.b"]}
+response: {"id", "imports": ["a.b"], "missing": ["a.c"],
+           "module", "metadata", "references"} or {"id", ..., "error": {"line", "pos", "msg"}}
+'''
+import os
+import sys
+import json
+import birdeec
+
+lsp_home = os.environ.get("BIRDEE_LSP_HOME")
+if lsp_home and lsp_home not in sys.path:
+    sys.path.insert(0, lsp_home)
+from BirdeeReferences import collect_references
+
+MARKER = "@@BIRDEE_WORKER@@ "
+module_metadata = dict() # tuple[module_names] -> str(json)
+
+def compile_request(req) -> dict:
+    for name, meta in req["metadata"].items():
+        module_metadata[tuple(name.split("."))] = meta
+    known = set(tuple(name.split(".")) for name in req["known"])
+    known.update(tuple(name.split(".")) for name in req["metadata"])
+    imports = set()
+    missing = []
+    def _module_resolver(modname, second_chance):
+        tmod = tuple(modname)
+        if not second_chance:
+            imports.add(tmod)
+            if tmod in known and tmod in module_metadata:
+                return ("$InMemoryModule", module_metadata[tmod])
+            return None
+        missing.append(".".join(modname))
+        return None
+
+    e = None
+    birdeec.set_module_resolver(_module_resolver)
+    try:
+        birdeec.set_source_file_path(req["path"])
+        birdeec.clear_compile_unit()
+        birdeec.top_level(req["source"])
+        birdeec.process_top_level()
+    except birdeec.TokenizerException:
+        e=birdeec.get_tokenizer_error()
+    except birdeec.CompileException:
+        e=birdeec.get_compile_error()
+    ret = {"id": req["id"], "imports": [".".join(m) for m in imports], "missing": missing}
+    if e:
+        ret["error"] = {"line": e.linenumber, "pos": e.pos, "msg": e.msg}
+    else:
+        ret["module"] = birdeec.get_module_name()
+        ret["metadata"] = birdeec.get_metadata_json()
+        ret["references"] = collect_references(req["path"])
+    return ret
+
+for line in sys.stdin:
+    if not line.strip():
+        continue
+    req = json.loads(line)
+    sys.stdout.write(MARKER + json.dumps(compile_request(req)) + "\n")
+    sys.stdout.flush()
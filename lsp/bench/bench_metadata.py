@@ -0,0 +1,84 @@
+'''
+Benchmark of loading the names of a module for completion: parsing the JSON
+.bmm against opening the binary .bmx, on synthetic metadata of growing size.
+Reports the time and the peak of allocated memory. Runs without birdeec:
+
+    python lsp/bench/bench_metadata.py
+'''
+import os
+import sys
+import json
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from BirdeeMetadata import dump_binary_metadata, read_binary_metadata
+
+SECTIONS = ("Classes", "Variables", "Functions", "FunctionTemplates", "FunctionTypes")
+
+def make_type(name):
+    return {"base": "class", "index": 0, "name": name}
+
+def make_proto(name, args):
+    return {"name": name, "args": [{"name": "a{}".format(i), "type": make_type("int")} for i in range(args)],
+        "return": make_type("int")}
+
+def make_metadata(classes):
+    return {
+        "Package": "bench.big",
+        "Imports": [["bench", "small"]],
+        "Classes": [{"name": "C{}".format(i), "template": None,
+            "fields": [{"access": "public", "def": {"name": "f{}".format(j), "type": make_type("int")}} for j in range(10)],
+            "funcs": [{"access": "public", "def": make_proto("m{}".format(j), 3)} for j in range(10)]}
+            for i in range(classes)],
+        "Variables": [{"name": "v{}".format(i), "type": make_type("C0")} for i in range(classes)],
+        "Functions": [make_proto("fn{}".format(i), 4) for i in range(classes)],
+        "FunctionTemplates": [{"name": "t{}".format(i), "source": "function t{}[T]() as T".format(i)} for i in range(classes // 10)],
+        "FunctionTypes": [make_proto("ft{}".format(i), 2) for i in range(classes // 10)],
+    }
+
+def names_from_json(path):
+    with open(path) as f:
+        meta = json.load(f)
+    return [item["name"] for key in SECTIONS for item in meta[key] if "name" in item]
+
+def names_from_binary(path, stamp):
+    binary = read_binary_metadata(path, stamp)
+    return [name for key in SECTIONS for name in binary.names(key)]
+
+def measure(func, *args):
+    begin = time.perf_counter()
+    ret = func(*args)
+    elapsed = (time.perf_counter() - begin) * 1e3
+    # tracing the allocations slows the run down, so the memory is measured apart
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return ret, elapsed, peak
+
+def main():
+    tdir = tempfile.mkdtemp(prefix="birdee-bench-")
+    json_path = os.path.join(tdir, "big.bmm")
+    bin_path = os.path.join(tdir, "big.bmx")
+    print("{:>8} {:>10} {:>10} {:>10} {:>12} {:>10} {:>12}".format("classes", "bmm(KB)", "bmx(KB)",
+        "json(ms)", "json(KB)", "bmx(ms)", "bmx(KB)"))
+    for classes in (100, 1000, 5000, 20000):
+        meta = make_metadata(classes)
+        with open(json_path, "w") as f:
+            json.dump(meta, f)
+        with open(bin_path, "wb") as f:
+            f.write(dump_binary_metadata(meta, "bench"))
+        assert read_binary_metadata(bin_path, "bench").to_dict() == meta
+        expected, json_ms, json_kb = measure(names_from_json, json_path)
+        names, bin_ms, bin_kb = measure(names_from_binary, bin_path, "bench")
+        assert names == expected
+        print("{:>8} {:>10.0f} {:>10.0f} {:>10.2f} {:>12.0f} {:>10.2f} {:>12.0f}".format(classes,
+            os.path.getsize(json_path) / 1024, os.path.getsize(bin_path) / 1024, json_ms, json_kb, bin_ms, bin_kb))
+    for path in (json_path, bin_path):
+        os.remove(path)
+    os.rmdir(tdir)
+
+if __name__ == "__main__":
+    main()
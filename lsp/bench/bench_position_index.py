@@ -0,0 +1,77 @@
+'''
+Benchmark of the position lookup used by go-to-definition: the walk over the
+top-level items near the line (find_near, used for the first lookup in a
+compile) against building and querying PositionIndex, on synthetic ASTs of
+growing size. Runs without birdeec:
+
+    python lsp/bench/bench_position_index.py
+'''
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from BirdeeIndex import PositionIndex, find_near
+
+class Pos:
+    def __init__(self, line, pos):
+        self.line = line
+        self.pos = pos
+
+class Node:
+    def __init__(self, line, pos, children):
+        self.pos = Pos(line, pos)
+        self.children = children
+
+    def run(self, func):
+        for c in self.children:
+            func(c)
+
+'''
+a top level function per 10 lines, each line holding a statement with a few
+nested expressions
+'''
+def make_ast(lines):
+    top = []
+    for start in range(1, lines + 1, 10):
+        stmts = []
+        for line in range(start + 1, min(start + 10, lines + 1)):
+            exprs = [Node(line, col, []) for col in (5, 9, 14, 20)]
+            stmts.append(Node(line, 24, [Node(line, 18, exprs)]))
+        top.append(Node(start, 1, stmts))
+    return top
+
+def build_index(tl):
+    index = PositionIndex()
+    def runfunc(ast):
+        index.add(ast.pos.line, ast.pos.pos, ast)
+        ast.run(runfunc)
+    for a in tl:
+        runfunc(a)
+    return index.finish()
+
+def timeit(func, queries):
+    begin = time.perf_counter()
+    for q in queries:
+        func(*q)
+    return (time.perf_counter() - begin) / len(queries) * 1e6
+
+def main():
+    random.seed(0)
+    print("{:>8} {:>8} {:>12} {:>14} {:>14}".format("lines", "nodes", "build(ms)", "near(us)", "index(us)"))
+    for lines in (100, 1000, 5000, 20000, 50000):
+        tl = make_ast(lines)
+        queries = [(random.randrange(lines), random.randrange(30), 30) for _ in range(2000)]
+        begin = time.perf_counter()
+        index = build_index(tl)
+        build = (time.perf_counter() - begin) * 1e3
+        for line, character, length in queries[:50]:
+            expected = [id(n) for _, n in find_near(tl, line + 1, character + 1, length)]
+            assert expected == [id(n) for _, n in index.find(line + 1, character + 1, length)]
+        near = timeit(lambda l, c, n: find_near(tl, l + 1, c + 1, n), queries)
+        indexed = timeit(lambda l, c, n: index.find(l + 1, c + 1, n), queries)
+        print("{:>8} {:>8} {:>12.2f} {:>14.2f} {:>14.2f}".format(lines, len(index), build, near, indexed))
+
+if __name__ == "__main__":
+    main()
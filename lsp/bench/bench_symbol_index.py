@@ -0,0 +1,65 @@
+'''
+Benchmark of workspace symbol queries: a scan over all the symbol names
+(what a query costs without an index) against SymbolIndex, on synthetic
+workspaces of growing size. Runs without birdeec:
+
+    python lsp/bench/bench_symbol_index.py
+'''
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from BirdeeIndex import SymbolIndex, is_subsequence
+
+WORDS = ("array", "buffer", "channel", "decoder", "event", "file", "graph", "hash", "index", "json",
+    "kernel", "list", "map", "node", "object", "parser", "queue", "reader", "socket", "thread")
+
+def make_modules(symbols):
+    random.seed(0)
+    modules = dict()
+    for i in range(symbols):
+        name = "".join(w.capitalize() for w in random.sample(WORDS, 3)) + str(i % 7)
+        modules.setdefault(("pkg{}".format(i % 50), "mod{}".format(i % 500)), []).append((name, i))
+    return modules
+
+def scan(modules, query):
+    query = query.lower()
+    ret = []
+    for symbols in modules.values():
+        for name, data in symbols:
+            lower = name.lower()
+            if query in lower or is_subsequence(query, lower):
+                ret.append((name, data))
+    return ret
+
+def timeit(func, queries):
+    begin = time.perf_counter()
+    for q in queries:
+        func(q)
+    return (time.perf_counter() - begin) / len(queries) * 1e3
+
+def main():
+    queries = ["parser", "ArrQue", "sock", "hm", "jsonevent", "node3", "xyz"]
+    print("{:>8} {:>12} {:>12} {:>12} {:>14}".format("symbols", "build(ms)", "scan(ms)", "index(ms)", "update(ms)"))
+    for count in (1000, 10000, 50000, 100000):
+        modules = make_modules(count)
+        index = SymbolIndex()
+        begin = time.perf_counter()
+        for mod, symbols in modules.items():
+            index.update(mod, symbols)
+        build = (time.perf_counter() - begin) * 1e3
+        for q in queries:
+            expected = set(data for _, data in scan(modules, q))
+            assert set(data for _, data in index.search(q, limit=len(index))) == expected
+        scanned = timeit(lambda q: scan(modules, q), queries)
+        indexed = timeit(lambda q: index.search(q), queries)
+        mod = next(iter(modules))
+        begin = time.perf_counter()
+        index.update(mod, modules[mod])
+        update = (time.perf_counter() - begin) * 1e3
+        print("{:>8} {:>12.1f} {:>12.2f} {:>12.2f} {:>14.3f}".format(len(index), build, scanned, indexed, update))
+
+if __name__ == "__main__":
+    main()
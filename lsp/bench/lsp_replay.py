@@ -0,0 +1,382 @@
+'''
+Replay benchmark of the Birdee language server. It generates a workspace of
+Birdee modules, starts BirdeeLSP.py over stdio against the stub birdeec in
+lsp/bench/stub, replays scripted editing sessions and reports p50/p95/p99
+latency per request type. With --baseline, the p95 of each request type is
+compared with the stored baseline and the script fails on regressions.
+
+    python lsp/bench/lsp_replay.py --sizes 10,100,500,2000
+    python lsp/bench/lsp_replay.py --baseline lsp/bench/baseline.json
+    python lsp/bench/lsp_replay.py --baseline lsp/bench/baseline.json --update-baseline
+    python lsp/bench/lsp_replay.py --sizes 10 --main-functions 1500
+
+The Python running this script needs pygls, like the language server. Set
+BIRDEE_BENCH_STDERR=1 to see the server's stderr. BIRDEE_STUB_LINE_US sets
+the simulated compile cost per line. The stored baseline depends on the
+machine, so regenerate it when you switch machines. --main-functions sets the
+size of the edited module, e.g. to check that completion stays flat on large
+files.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from queue import Queue, Empty
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LSP_DIR = os.path.dirname(BENCH_DIR)
+MODULES_PER_PACKAGE = 50
+
+def module_name(i):
+    return ("pkg{}".format(i // MODULES_PER_PACKAGE), "mod{}".format(i))
+
+def module_source(i, extra_functions=0):
+    pkg, mod = module_name(i)
+    lines = ["package " + pkg, ""]
+    for dep in sorted({i - 1, i // 2, i // 3}):
+        if 0 <= dep < i:
+            lines.append("import {}.{}".format(*module_name(dep)))
+    lines += ["", "class C{}".format(i)]
+    for j in range(8):
+        lines.append("    public field{} as int".format(j))
+    for j in range(4):
+        lines += ["    function method{}(a as int) as int".format(j), "        return a", "    end"]
+    lines += ["end", ""]
+    for j in range(6 + extra_functions):
+        lines += ["function f{}_{}(a as int, b as int) as int".format(i, j),
+            "    dim obj = new C{}".format(i),
+            "    dim v as int",
+            "    v = a",
+            "    v = obj.field1"]
+        if i > 0:
+            lines.append("    v = f{}_1(v, b)".format(i - 1))
+        lines += ["    v = f{}_0(v, b)".format(i),
+            "    return v",
+            "end", ""]
+    return "\n".join(lines)
+
+def generate_workspace(root, size, main_functions=150):
+    for i in range(size):
+        pkg, mod = module_name(i)
+        os.makedirs(os.path.join(root, pkg), exist_ok=True)
+        # the last module is the one edited in the sessions, make it large
+        src = module_source(i, main_functions if i == size - 1 else 0)
+        with open(os.path.join(root, pkg, mod + ".bdm"), "w") as f:
+            f.write(src)
+    pkg, mod = module_name(size - 1)
+    return os.path.join(root, pkg, mod + ".bdm")
+
+def path_to_uri(path):
+    return "file://" + os.path.abspath(path).replace(os.sep, "/")
+
+class Client:
+    def __init__(self, root, settings):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.join(BENCH_DIR, "stub"), env.get("PYTHONPATH", "")])
+        env["BIRDEE_LSP_HOME"] = LSP_DIR
+        env["BIRDEE_HOME"] = os.path.join(root, ".birdee_home")
+        os.makedirs(os.path.join(env["BIRDEE_HOME"], "blib"), exist_ok=True)
+        self.proc = subprocess.Popen([sys.executable, os.path.join(LSP_DIR, "BirdeeLSP.py")],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None if os.environ.get("BIRDEE_BENCH_STDERR") else subprocess.DEVNULL, env=env, cwd=root)
+        self.next_id = 0
+        self.mutex = threading.Lock()
+        self.responses = dict() # int(id) -> Queue
+        self.diagnostics = Queue() # (time, uri, diagnostics)
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        self.capabilities = self.request("initialize", {"processId": os.getpid(), "rootPath": root,
+            "rootUri": path_to_uri(root), "capabilities": {"textDocument": {"semanticTokens": {
+                "requests": {"full": {"delta": True}}, "tokenTypes": [], "tokenModifiers": [],
+                "formats": ["relative"]}}}})["capabilities"]
+        self.notify("initialized", {})
+        self.notify("workspace/didChangeConfiguration", {"settings": {"birdeeLanguageServer": settings}})
+
+    def send(self, msg):
+        body = json.dumps(msg).encode("utf-8")
+        with self.mutex:
+            self.proc.stdin.write("Content-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            self.proc.stdin.flush()
+
+    def read_loop(self):
+        out = self.proc.stdout
+        while True:
+            length = None
+            while True:
+                line = out.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if not line:
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            msg = json.loads(out.read(length))
+            if "method" in msg and "id" in msg:
+                # requests from the server, e.g. client/registerCapability
+                self.send({"jsonrpc": "2.0", "id": msg["id"], "result": None})
+            elif "method" in msg:
+                if msg["method"] == "textDocument/publishDiagnostics":
+                    self.diagnostics.put((time.perf_counter(), msg["params"]["uri"], msg["params"]["diagnostics"]))
+            else:
+                queue = self.responses.get(msg["id"])
+                if queue:
+                    queue.put(msg)
+
+    def request(self, method, params, timeout=120):
+        self.next_id += 1
+        queue = Queue()
+        self.responses[self.next_id] = queue
+        self.send({"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params})
+        msg = queue.get(timeout=timeout)
+        del self.responses[self.next_id]
+        if "error" in msg:
+            raise RuntimeError("{} failed: {}".format(method, msg["error"]))
+        return msg.get("result")
+
+    def notify(self, method, params):
+        self.send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def drain_diagnostics(self):
+        while True:
+            try:
+                self.diagnostics.get_nowait()
+            except Empty:
+                return
+
+    def wait_diagnostics(self, uri, timeout=120):
+        deadline = time.perf_counter() + timeout
+        while True:
+            t, duri, diags = self.diagnostics.get(timeout=max(deadline - time.perf_counter(), 0.001))
+            if duri == uri:
+                return t, diags
+
+    def close(self):
+        try:
+            self.request("shutdown", None, timeout=30)
+            self.notify("exit", None)
+        except Exception:
+            pass
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+class Session:
+    def __init__(self, client, path):
+        self.client = client
+        self.uri = path_to_uri(path)
+        with open(path) as f:
+            self.lines = f.read().split("\n")
+        self.version = 1
+        self.samples = dict() # str(request type) -> list of ms
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds * 1000)
+
+    def change(self, line, col, end_line, end_col, text):
+        self.version += 1
+        before = self.lines[line][:col]
+        after = self.lines[end_line][end_col:]
+        self.lines[line:end_line + 1] = (before + text + after).split("\n")
+        self.client.notify("textDocument/didChange", {"textDocument": {"uri": self.uri, "version": self.version},
+            "contentChanges": [{"range": {"start": {"line": line, "character": col},
+                "end": {"line": end_line, "character": end_col}}, "text": text}]})
+
+    def insert_line(self, line, text):
+        self.change(line, 0, line, 0, text + "\n")
+
+    def delete_line(self, line):
+        self.change(line, 0, line + 1, 0, "")
+
+    def find_line(self, text, start=0):
+        for i in range(start, len(self.lines)):
+            if self.lines[i].strip() == text:
+                return i
+        raise ValueError(text)
+
+    def timed_request(self, name, method, params):
+        begin = time.perf_counter()
+        result = self.client.request(method, params)
+        self.record(name, time.perf_counter() - begin)
+        # an empty answer is cheap, don't let a broken feature look fast
+        if not result:
+            raise RuntimeError("{} returned nothing".format(name))
+        return result
+
+    def open(self):
+        self.client.drain_diagnostics()
+        begin = time.perf_counter()
+        self.client.notify("textDocument/didOpen", {"textDocument": {"uri": self.uri, "languageId": "Birdee",
+            "version": self.version, "text": "\n".join(self.lines)}})
+        t, diags = self.client.wait_diagnostics(self.uri)
+        self.record("open", t - begin)
+        if diags:
+            raise RuntimeError("unexpected diagnostics on open: {}".format(diags))
+
+    def definition(self):
+        line = self.find_line("v = obj.field1", len(self.lines) // 2)
+        col = self.lines[line].index("obj") + 1
+        self.timed_request("definition", "textDocument/definition",
+            {"textDocument": {"uri": self.uri}, "position": {"line": line, "character": col}})
+
+    def completion_dot(self):
+        line = self.find_line("return v", len(self.lines) // 2)
+        self.insert_line(line, "    obj.")
+        self.timed_request("completion_dot", "textDocument/completion", {"textDocument": {"uri": self.uri},
+            "position": {"line": line, "character": len("    obj.")},
+            "context": {"triggerKind": 2, "triggerCharacter": "."}})
+        self.delete_line(line)
+
+    def completion_import(self):
+        self.insert_line(2, "import pkg0.")
+        self.timed_request("completion_import", "textDocument/completion", {"textDocument": {"uri": self.uri},
+            "position": {"line": 2, "character": len("import pkg0.")},
+            "context": {"triggerKind": 2, "triggerCharacter": "."}})
+        self.delete_line(2)
+
+    def signature_help(self):
+        line = self.find_line("return v", len(self.lines) // 2)
+        # the line before is a call: "v = f<i>_0(v, b)"
+        call = self.lines[line - 1].strip()
+        text = "    " + call[:call.index("(") + 1] + "v,"
+        self.insert_line(line, text)
+        self.timed_request("signature_help", "textDocument/signatureHelp", {"textDocument": {"uri": self.uri},
+            "position": {"line": line, "character": len(text)}})
+        # typing the next argument retriggers the help in the same call
+        self.change(line, len(text), line, len(text), " b,")
+        self.timed_request("signature_retrigger", "textDocument/signatureHelp", {"textDocument": {"uri": self.uri},
+            "position": {"line": line, "character": len(text) + 3}})
+        self.delete_line(line)
+
+    def references(self):
+        # a function of the imported module i - 1, called in every function
+        line = self.find_line("return v", len(self.lines) // 2)
+        call = self.lines[line - 2]
+        col = call.index("f")
+        self.timed_request("references", "textDocument/references", {"textDocument": {"uri": self.uri},
+            "position": {"line": line - 2, "character": col}, "context": {"includeDeclaration": True}})
+
+    def semantic_tokens(self):
+        if "semanticTokensProvider" not in self.client.capabilities:
+            raise RuntimeError("semantic tokens are not advertised")
+        full = self.timed_request("semantic_tokens_full", "textDocument/semanticTokens/full",
+            {"textDocument": {"uri": self.uri}})
+        line = self.find_line("return v", len(self.lines) // 2)
+        self.insert_line(line, "    v = a")
+        delta = self.timed_request("semantic_tokens_delta", "textDocument/semanticTokens/full/delta",
+            {"textDocument": {"uri": self.uri}, "previousResultId": full["resultId"]})
+        if "edits" not in delta:
+            raise RuntimeError("semantic_tokens_delta returned all the tokens")
+        self.delete_line(line)
+
+    def workspace_symbol(self):
+        self.timed_request("workspace_symbol", "workspace/symbol", {"query": "f1_"})
+
+    def type_storm(self):
+        line = self.find_line("return v", len(self.lines) // 2)
+        self.insert_line(line, "    ")
+        text = "dim storm = v"
+        for i, ch in enumerate(text):
+            self.change(line, 4 + i, line, 4 + i, ch)
+        self.client.drain_diagnostics()
+        begin = time.perf_counter()
+        # the first diagnostics may come from a compile started during the storm
+        t, diags = self.client.wait_diagnostics(self.uri)
+        self.record("type_storm", t - begin)
+        self.delete_line(line)
+
+    def save(self):
+        self.client.drain_diagnostics()
+        begin = time.perf_counter()
+        self.client.notify("textDocument/didSave", {"textDocument": {"uri": self.uri}})
+        t, diags = self.client.wait_diagnostics(self.uri)
+        self.record("save", t - begin)
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def run_size(size, rounds, settings, main_functions=150):
+    root = tempfile.mkdtemp(prefix="birdee-bench-")
+    try:
+        main_path = generate_workspace(root, size, main_functions)
+        client = Client(root, settings)
+        try:
+            session = Session(client, main_path)
+            session.open()
+            for _ in range(rounds):
+                session.definition()
+                session.completion_dot()
+                session.completion_import()
+                session.signature_help()
+                session.references()
+                session.semantic_tokens()
+                session.workspace_symbol()
+                session.type_storm()
+                session.save()
+            stats = client.request("birdee/stats", None)
+        finally:
+            client.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    ret = dict()
+    for name, samples in session.samples.items():
+        ret[name] = {"p50": percentile(samples, 50), "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99), "n": len(samples)}
+    return ret, stats
+
+def compare(results, baseline, tolerance, slack):
+    regressions = []
+    for size, reqs in results.items():
+        for name, cur in reqs.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            limit = base["p95"] * (1 + tolerance) + slack
+            if cur["p95"] > limit:
+                regressions.append("{} modules, {}: p95 {:.1f} ms > {:.1f} ms (baseline {:.1f} ms)".format(
+                    size, name, cur["p95"], limit, base["p95"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,500,2000", help="comma separated numbers of modules")
+    parser.add_argument("--rounds", type=int, default=20, help="repetitions of each request in a session")
+    parser.add_argument("--baseline", help="baseline JSON to compare with or to update")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 increase")
+    parser.add_argument("--slack", type=float, default=5.0, help="allowed absolute p95 increase in ms")
+    parser.add_argument("--main-functions", type=int, default=150, help="extra functions in the edited module")
+    parser.add_argument("--settings", default="{}", help="JSON overriding the server settings")
+    args = parser.parse_args()
+    settings = {"sourceRoot": ".", "lspCache": ".BirdeeCache", "diagnosticsDelay": 50}
+    settings.update(json.loads(args.settings))
+
+    results = dict()
+    print("{:>8} {:<22} {:>9} {:>9} {:>9}".format("modules", "request", "p50(ms)", "p95(ms)", "p99(ms)"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        res, _ = run_size(size, args.rounds, settings, args.main_functions)
+        results[str(size)] = res
+        for name, r in sorted(res.items()):
+            print("{:>8} {:<22} {:>9.2f} {:>9.2f} {:>9.2f}".format(size, name, r["p50"], r["p95"], r["p99"]))
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.slack)
+        for r in regressions:
+            print("REGRESSION: " + r)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
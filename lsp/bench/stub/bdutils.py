@@ -0,0 +1,11 @@
+'''
+A stand-in of bdutils for the benchmark stub of birdeec
+'''
+
+def foreach_field(clz, func):
+    for idx, field in enumerate(clz.fields):
+        func(idx, len(clz.fields), field)
+
+def foreach_method(clz, func):
+    for idx, method in enumerate(clz.funcs):
+        func(idx, len(clz.funcs), method)
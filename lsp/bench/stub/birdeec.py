@@ -0,0 +1,408 @@
+'''
+A stand-in of the birdeec Python module for benchmarking the language server
+on a machine without the Birdee compiler. It understands the small subset of
+Birdee written by lsp_replay.py, builds an AST of the same shape the server
+walks, and simulates the compile cost with a busy wait per non-blank source
+line (BIRDEE_STUB_LINE_US microseconds, 20 by default).
+'''
+import os
+import re
+import json
+import time
+from enum import Enum
+
+LINE_COST = float(os.environ.get("BIRDEE_STUB_LINE_US", "20")) / 1e6
+TOKEN = re.compile(r"[A-Za-z_]\w*|\S")
+
+class TokenizerException(Exception):
+    pass
+
+class CompileException(Exception):
+    pass
+
+class CompileError:
+    def __init__(self, msg, linenumber, pos):
+        self.msg = msg
+        self.linenumber = linenumber
+        self.pos = pos
+
+class BasicType(Enum):
+    INT = 0
+    CLASS = 1
+    FUNC = 2
+
+class SourcePos:
+    def __init__(self, line, pos, source_path=None):
+        self.line = line
+        self.pos = pos
+        self.source_idx = -1 if source_path is None else 0
+        self.source_path = source_path
+
+class ResolvedType:
+    def __init__(self, base, detail=None, name="int"):
+        self.base = base
+        self.index_level = 0
+        self.detail = detail
+        self.name = name
+
+    def get_detail(self):
+        return self.detail
+
+    def __str__(self):
+        return self.name
+
+class StatementAST:
+    def __init__(self, pos, children=()):
+        self.pos = pos
+        self.children = list(children)
+
+    def run(self, func):
+        for c in self.children:
+            func(c)
+
+class VariableSingleDefAST(StatementAST):
+    def __init__(self, name, pos, resolved_type):
+        super().__init__(pos)
+        self.name = name
+        self.resolved_type = resolved_type
+
+class PrototypeAST:
+    def __init__(self, name, args, return_type):
+        self.name = name
+        self.args = args
+        self.return_type = return_type
+
+class FunctionAST(StatementAST):
+    def __init__(self, proto, pos, children=()):
+        super().__init__(pos, children)
+        self.proto = proto
+
+class FieldDef:
+    def __init__(self, decl):
+        self.decl = decl
+
+class MemberFunctionDef:
+    def __init__(self, decl):
+        self.decl = decl
+
+class ClassAST(StatementAST):
+    def __init__(self, name, pos):
+        super().__init__(pos)
+        self.name = name
+        self.fields = []
+        self.funcs = []
+
+class LocalVarExprAST(StatementAST):
+    def __init__(self, pos, vardef):
+        super().__init__(pos)
+        self.vardef = vardef
+
+class ResolvedFuncExprAST(StatementAST):
+    def __init__(self, pos, funcdef):
+        super().__init__(pos)
+        self.funcdef = funcdef
+
+class MemberExprAST(StatementAST):
+    class MemberType(Enum):
+        ERROR = 0
+        FIELD = 1
+        FUNCTION = 2
+        VIRTUAL_FUNCTION = 3
+        IMPORTED_DIM = 4
+        IMPORTED_FUNCTION = 5
+
+    def __init__(self, pos, obj, kind, member):
+        super().__init__(pos, [obj])
+        self.kind = kind
+        self.field = member if kind == MemberExprAST.MemberType.FIELD else None
+        self.func = member if kind == MemberExprAST.MemberType.FUNCTION else None
+
+class AutoCompletionExprAST(StatementAST):
+    class CompletionKind(Enum):
+        DOT = 0
+        NEW = 1
+        PARAMETER = 2
+
+    def __init__(self, pos, kind, resolved_type, parameter_number=0):
+        super().__init__(pos)
+        self.kind = kind
+        self.resolved_type = resolved_type
+        self.parameter_number = parameter_number
+
+class ImportedModule:
+    def __init__(self, meta):
+        self.meta = meta
+
+    def get_classmap(self):
+        return {c["name"]: c for c in self.meta["Classes"]}
+
+    def get_dimmap(self):
+        return {v["name"]: v for v in self.meta["Variables"]}
+
+    def get_funcmap(self):
+        return {f["name"]: f for f in self.meta["Functions"]}
+
+    def get_functypemap(self):
+        return {}
+
+    def get_imported_classmap(self):
+        return {}
+
+    def get_imported_dimmap(self):
+        return {}
+
+    def get_imported_funcmap(self):
+        return {}
+
+    def get_imported_functypemap(self):
+        return {}
+
+class ImportTree:
+    def __init__(self, mod):
+        self.mod = mod
+
+    def get_submodules(self):
+        return []
+
+class _CompileUnit:
+    def __init__(self):
+        self.resolver = None
+        self.path = None
+        self.module_name = ""
+        self.toplevel = []
+        self.classes = dict()
+        self.functions = dict()
+        self.imported_functions = dict() # str(name) -> FunctionAST declared in an imported module
+        self.imports = dict() # str(module name) -> metadata dict
+        self.error = None
+        self.auto_completion = None
+        self.source = ""
+
+_cu = _CompileUnit()
+
+def set_module_resolver(func):
+    _cu.resolver = func
+
+def set_source_file_path(path):
+    _cu.path = path
+
+def clear_compile_unit():
+    resolver = _cu.resolver
+    path = _cu.path
+    _cu.__init__()
+    _cu.resolver = resolver
+    _cu.path = path
+
+def _fail(msg, line, pos):
+    _cu.error = CompileError(msg, line, pos)
+    raise CompileException(msg)
+
+def _type_of(name):
+    if name in _cu.classes:
+        return ResolvedType(BasicType.CLASS, _cu.classes[name], name)
+    return ResolvedType(BasicType.INT, None, name)
+
+def top_level(source):
+    try:
+        _top_level(source)
+    except (IndexError, KeyError, AttributeError, TypeError):
+        _fail("Syntax error", 0, 0)
+
+def _top_level(source):
+    _cu.source = source
+    lines = source.split("\n")
+    deadline = time.perf_counter() + LINE_COST * sum(1 for line in lines if line.strip())
+    while time.perf_counter() < deadline:
+        pass
+    package = None
+    cur_class = None
+    cur_func = None
+    for lineno, line in enumerate(lines, 1):
+        text = line.strip()
+        tokens = TOKEN.findall(text)
+        if not tokens:
+            continue
+        if tokens[0] == "package":
+            package = text[len("package "):].strip()
+        elif tokens[0] == "import":
+            _import(text[len("import "):].strip(), lineno)
+        elif tokens[0] == "class":
+            cur_class = ClassAST(tokens[1], SourcePos(lineno, 1))
+            _cu.classes[cur_class.name] = cur_class
+            _cu.toplevel.append(cur_class)
+        elif tokens[0] == "function":
+            proto = _proto(tokens, lineno)
+            cur_func = FunctionAST(proto, SourcePos(lineno, len(line) + 1))
+            cur_func.locals = {arg.name: arg for arg in proto.args}
+            if cur_class:
+                cur_class.funcs.append(MemberFunctionDef(cur_func))
+            else:
+                _cu.functions[proto.name] = cur_func
+                _cu.toplevel.append(cur_func)
+        elif tokens[0] == "public" and cur_class and not cur_func:
+            cur_class.fields.append(FieldDef(VariableSingleDefAST(tokens[1], SourcePos(lineno, 8), _type_of(tokens[3]))))
+        elif tokens[0] == "end":
+            if cur_func:
+                cur_func = None
+            else:
+                cur_class = None
+        elif cur_func:
+            cur_func.body = getattr(cur_func, "body", [])
+            cur_func.body.append((lineno, line))
+        else:
+            _fail("Unexpected " + tokens[0], lineno - 1, 0)
+    base = os.path.splitext(os.path.basename(_cu.path or "main"))[0]
+    _cu.module_name = package + "." + base if package else base
+
+def _import(name, lineno):
+    modname = name.split(":")[0].split(".")
+    ret = _cu.resolver(modname, False)
+    if not ret:
+        ret = _cu.resolver(modname, True)
+    if not ret:
+        _fail("Cannot resolve module " + ".".join(modname), lineno - 1, 0)
+    meta = json.loads(ret[1])
+    _cu.imports[".".join(modname)] = meta
+    # the stub records the source file in the metadata, birdeec keeps it with
+    # the positions of the imported declarations
+    for func in meta["Functions"]:
+        pos = SourcePos(func["pos"]["line"], func["pos"]["pos"], meta.get("SourceFile"))
+        _cu.imported_functions[func["name"]] = FunctionAST(PrototypeAST(func["name"], [], _type_of("int")), pos)
+
+def _proto(tokens, lineno):
+    args = []
+    i = 3
+    while i < len(tokens) and tokens[i] != ")":
+        if tokens[i] != ",":
+            args.append(VariableSingleDefAST(tokens[i], SourcePos(lineno, 1), _type_of(tokens[i + 2])))
+            i += 3
+        else:
+            i += 1
+    return PrototypeAST(tokens[1], args, _type_of(tokens[-1]))
+
+def process_top_level():
+    try:
+        _process_top_level()
+    except (IndexError, KeyError, AttributeError, TypeError):
+        _fail("Syntax error", 0, 0)
+
+def _process_top_level():
+    for ast in list(_cu.toplevel):
+        funcs = [ast] if isinstance(ast, FunctionAST) else [f.decl for f in ast.funcs]
+        for func in funcs:
+            for lineno, line in getattr(func, "body", []):
+                func.children.append(_statement(func, lineno, line))
+
+'''
+one statement per line. Every identifier becomes a node positioned at the
+column after its end, like the expressions of birdeec
+'''
+def _statement(func, lineno, line):
+    stmt = StatementAST(SourcePos(lineno, len(line) + 1))
+    tokens = [(m.group(), m.end() + 1) for m in TOKEN.finditer(line)]
+    calls = [] # stack of (prototype, number of commas)
+    prev = None
+    def text_at(i):
+        return tokens[i][0] if i < len(tokens) else ""
+    for i, (tok, end) in enumerate(tokens):
+        if tok == ":":
+            _auto_complete(func, tokens, i, calls, lineno, end)
+        if tok == "dim":
+            name = text_at(i + 1)
+            if text_at(i + 2) == "as":
+                tyname = text_at(i + 3)
+            elif text_at(i + 3) == "new":
+                tyname = text_at(i + 4)
+            else:
+                tyname = "int"
+            func.locals[name] = VariableSingleDefAST(name, SourcePos(lineno, tokens[i + 1][1]), _type_of(tyname))
+            stmt.children.append(func.locals[name])
+        elif tok == "(":
+            callee = _cu.functions.get(prev[0]) if prev else None
+            calls.append((callee.proto if callee else None, 0))
+        elif tok == ",":
+            if calls:
+                calls[-1] = (calls[-1][0], calls[-1][1] + 1)
+        elif tok == ")":
+            if calls:
+                calls.pop()
+        elif tok in func.locals:
+            stmt.children.append(LocalVarExprAST(SourcePos(lineno, end), func.locals[tok]))
+        elif tok in _cu.functions:
+            stmt.children.append(ResolvedFuncExprAST(SourcePos(lineno, end), _cu.functions[tok]))
+        elif tok in _cu.imported_functions:
+            stmt.children.append(ResolvedFuncExprAST(SourcePos(lineno, end), _cu.imported_functions[tok]))
+        elif prev and prev[0] == "." and i >= 2 and tokens[i - 2][0] in func.locals:
+            member = _member(func.locals[tokens[i - 2][0]].resolved_type, tok)
+            if member:
+                obj = LocalVarExprAST(SourcePos(lineno, tokens[i - 2][1]), func.locals[tokens[i - 2][0]])
+                stmt.children.append(MemberExprAST(SourcePos(lineno, end), obj, member[0], member[1]))
+        prev = (tok, end)
+    return stmt
+
+def _member(ty, name):
+    detail = ty.get_detail()
+    if not isinstance(detail, ClassAST):
+        return None
+    for field in detail.fields:
+        if field.decl.name == name:
+            return (MemberExprAST.MemberType.FIELD, field)
+    for f in detail.funcs:
+        if f.decl.proto.name == name:
+            return (MemberExprAST.MemberType.FUNCTION, f)
+    return None
+
+def _auto_complete(func, tokens, i, calls, lineno, end):
+    kind = AutoCompletionExprAST.CompletionKind
+    prev = tokens[i - 1][0] if i > 0 else None
+    expr = None
+    if prev == "." and i >= 2:
+        owner = tokens[i - 2][0]
+        if owner in _cu.imports:
+            ty = ResolvedType(BasicType.CLASS, ImportTree(ImportedModule(_cu.imports[owner])), owner)
+        else:
+            local = func.locals.get(owner)
+            ty = local.resolved_type if local else _type_of(owner)
+        expr = AutoCompletionExprAST(SourcePos(lineno, end), kind.DOT, ty)
+    elif prev == "new":
+        expr = AutoCompletionExprAST(SourcePos(lineno, end), kind.NEW, ResolvedType(BasicType.CLASS))
+    elif calls and calls[-1][0]:
+        proto, commas = calls[-1]
+        expr = AutoCompletionExprAST(SourcePos(lineno, end), kind.PARAMETER,
+            ResolvedType(BasicType.FUNC, proto, proto.name), commas)
+    _cu.auto_completion = expr
+    _fail("Auto completion", lineno - 1, end - 1)
+
+def get_tokenizer_error():
+    return _cu.error
+
+def get_compile_error():
+    return _cu.error
+
+def get_auto_completion_ast():
+    return _cu.auto_completion
+
+def get_top_level():
+    return _cu.toplevel
+
+def get_module_name():
+    return _cu.module_name
+
+def get_classes(imported):
+    return {} if imported else dict(_cu.classes)
+
+def get_functypes(imported):
+    return {}
+
+def get_metadata_json():
+    classes = []
+    for name, clz in _cu.classes.items():
+        classes.append({"name": name, "fields": [{"name": f.decl.name, "type": str(f.decl.resolved_type)} for f in clz.fields],
+            "funcs": [{"name": f.decl.proto.name} for f in clz.funcs]})
+    functions = []
+    for name, func in _cu.functions.items():
+        functions.append({"name": name, "args": [a.name for a in func.proto.args],
+            "pos": {"line": func.pos.line, "pos": func.pos.pos}})
+    return json.dumps({"Type": "Birdee Module Metadata", "Version": 1, "Package": _cu.module_name,
+        "SourceFile": _cu.path, "Imports": sorted(_cu.imports), "Classes": classes, "Functions": functions,
+        "Variables": [], "FunctionTemplates": [], "FunctionTypes": []})
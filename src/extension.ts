@@ -35,7 +35,9 @@ export function activate(context: ExtensionContext) {
   if (compilerPath === "") {
     compilerPath = process.env["BIRDEE_HOME"] + "/bin/birdeec";
   }
-  let commandOptions: ExecutableOptions = { stdio: 'pipe', detached: false };
+  // lets the server find its sibling modules when birdeec does not set __file__
+  let serverEnv = Object.assign({}, process.env, { BIRDEE_LSP_HOME: context.asAbsolutePath('lsp') });
+  let commandOptions: ExecutableOptions = { stdio: 'pipe', detached: false, env: serverEnv };
   let serverOptions: Executable = {
     command: compilerPath,
     args: ["-s", "-i", serverCommand, "-o", "111.obj", "-l", cachePath],